@@ -1,637 +1,984 @@
-from flask import Flask, render_template, request, send_file
-from PIL import Image, ImageDraw, ImageFont
+from flask import (
+    Flask, Response, g, jsonify, render_template, request, send_file, send_from_directory, stream_with_context,
+)
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import csv
+import functools
+import gc
+import hashlib
+import hmac
 import io
+import json
+import math
+import multiprocessing
 import os
-import platform
+import threading
+import time
+import unicodedata
+import zipfile
+from urllib.parse import quote
+
+from image_generator import (
+    OUTPUT_FORMATS, LRUCache, MatchInputError, create_generator, encode_image,
+    encode_match, encode_match_sizes, font_cache, image_nbytes, iter_png, match_filename, metrics,
+    parse_animation_option, parse_match_form, parse_output_options, parse_size_options,
+    parse_theme_option,
+)
+from league import StandingsStore
+from profiling import StackProfiler
 
 app = Flask(__name__)
 
-class TableTennisImageGenerator:
-    def __init__(self):
-        self.width = 1080
-        self.height = 1080
-        self.bg_color = (255, 255, 255)
-        self.primary_color = (41, 128, 185)
-        self.secondary_color = (52, 73, 94)
-        self.accent_color = (231, 76, 60)
-        
-        # フォント設定を初期化
-        self.setup_fonts()
+# グローバルインスタンス（フォントはfork前に読み込んで各ワーカーで共有する）
+generator = create_generator()
+
+# 生成結果（エンコード済みバイト列）のキャッシュ（同一試合の再送信・再ダウンロード用、バイト数で上限管理）
+result_cache = LRUCache(max_size=int(os.environ.get('RESULT_CACHE_SIZE', 1024)),
+                        max_bytes=int(os.environ.get('RESULT_CACHE_BYTES', 64 * 1024 * 1024)),
+                        sizeof=len)
+
+def result_cache_key(player1, player2, scores, match_type, output_format='png', level=None,
+                     width=None, animated=False, size=None, theme=None):
+    """試合内容・テーマ・出力形式（・プレビュー幅・出力サイズ）から結果画像のハッシュ（ETagとしても使用）を計算"""
+    theme_key = generator.get_theme_key(theme) if hasattr(generator, 'get_theme_key') else None
+    normalized_scores = [[int(score1), int(score2)] for score1, score2 in scores]
+    payload = json.dumps([player1, player2, normalized_scores, match_type, theme_key,
+                          output_format, level, width, animated, size], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+# Server-Timingヘッダーを付けるか（ブラウザの開発者ツールで段階別の時間を確認できる）
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+
+@app.before_request
+def begin_request_metrics():
+    g.metrics_start = time.perf_counter()
+    metrics.begin()
+
+@app.after_request
+def finish_request_metrics(response):
+    start = g.get('metrics_start')
+    if start is not None:
+        metrics.add('total', time.perf_counter() - start)
+    memory = metrics.current_memory()
+    timings = metrics.finish(request.endpoint or 'unknown', response.status_code)
+    if SERVER_TIMING and timings:
+        response.headers['Server-Timing'] = ', '.join(
+            f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in timings.items())
+    if SERVER_TIMING and memory is not None and memory.peak and not memory.deferred:
+        response.headers['X-Peak-Bytes'] = str(memory.peak)
+    return response
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+def encode_match_image(player1, player2, scores, match_type, output_format='png', level=None,
+                       animated=False, theme=None):
+    """画像を生成してエンコードしたバイト列にする（ワーカープロセスからも呼ばれる）"""
+    return encode_match(generator, player1, player2, scores, match_type, output_format, level,
+                        animated, theme)
+
+def prepare_for_fork():
+    """
+    fork前にフォントとキャッシュを読み込み、ワーカー間でメモリを共有できる状態にする
     
-    def setup_fonts(self):
-        """OS別に最適なフォントを設定"""
-        self.japanese_fonts = {}
-        self.english_fonts = {}
-        
-        system = platform.system()
-        print(f"Detected OS: {system}")
-        
-        if system == "Linux":  # Render環境
-            self.setup_linux_fonts()
-        elif system == "Windows":
-            self.setup_windows_fonts()
-        elif system == "Darwin":  # macOS
-            self.setup_macos_fonts()
-        else:
-            self.setup_fallback_fonts()
-    
-    def setup_linux_fonts(self):
-        """Linux環境（Render含む）用フォント設定"""
-
-        # ✅ カスタムフォントを最優先で使用
-        custom_path = os.path.join(os.path.dirname(__file__), "fonts/NotoSansCJKjp-Regular.otf")
-        if os.path.exists(custom_path):
-            self.japanese_fonts['regular'] = custom_path
-            self.japanese_fonts['bold'] = custom_path
-            self.japanese_fonts['italic'] = custom_path
-            self.japanese_fonts['bold_italic'] = custom_path
-            print(f"✓ Custom font loaded from: {custom_path}")
-            # 英語フォントも同時に設定
-            self.setup_english_fonts_linux()
-            return
-
-        # 日本語フォント候補（優先順）
-        japanese_font_paths = [
-            # Noto Fonts（最も信頼性が高い）
-            "/usr/share/fonts/opentype/noto/NotoSansCJKjp-Regular.otf",
-            "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
-            "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
-            # DejaVu系（英数字でも使用可能）
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Oblique.ttf",
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans-BoldOblique.ttf",
-            # Liberation系
-            "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
-            "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
-            "/usr/share/fonts/truetype/liberation/LiberationSans-Italic.ttf",
-            "/usr/share/fonts/truetype/liberation/LiberationSans-BoldItalic.ttf",
-            # Ubuntu系（GitHub Actionsでよく使用される）
-            "/usr/share/fonts/truetype/ubuntu/Ubuntu-Regular.ttf",
-            "/usr/share/fonts/truetype/ubuntu/Ubuntu-Bold.ttf",
-            "/usr/share/fonts/truetype/ubuntu/Ubuntu-Italic.ttf",
-            "/usr/share/fonts/truetype/ubuntu/Ubuntu-BoldItalic.ttf",
-        ]
-        
-        self.load_font_variants(japanese_font_paths, self.japanese_fonts, "Japanese")
-        # 英語フォントを別途設定
-        self.setup_english_fonts_linux()
-    
-    def setup_english_fonts_linux(self):
-        """Linux環境用英語フォント設定（日本語フォントとは別に）"""
-        # 英数字専用フォント候補
-        english_font_paths = [
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Oblique.ttf",
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans-BoldOblique.ttf",
-            "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
-            "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
-            "/usr/share/fonts/truetype/liberation/LiberationSans-Italic.ttf",
-            "/usr/share/fonts/truetype/liberation/LiberationSans-BoldItalic.ttf",
-            "/usr/share/fonts/truetype/ubuntu/Ubuntu-Regular.ttf",
-            "/usr/share/fonts/truetype/ubuntu/Ubuntu-Bold.ttf",
-            "/usr/share/fonts/truetype/ubuntu/Ubuntu-Italic.ttf",
-            "/usr/share/fonts/truetype/ubuntu/Ubuntu-BoldItalic.ttf",
-        ]
-        
-        self.load_font_variants(english_font_paths, self.english_fonts, "English")
-    
-    def setup_windows_fonts(self):
-        """Windows環境用フォント設定"""
-        # 日本語フォント
-        japanese_font_paths = [
-            "C:/Windows/Fonts/msgothic.ttc",      # MS Gothic
-            "C:/Windows/Fonts/msmincho.ttc",      # MS Mincho
-            "C:/Windows/Fonts/NotoSansCJK-Regular.ttc",  # もしインストールされていれば
-            "C:/Windows/Fonts/yugothm.ttc",       # Yu Gothic Medium
-            "C:/Windows/Fonts/yugothb.ttc",       # Yu Gothic Bold
-        ]
-        
-        # 英数字フォント
-        english_font_paths = [
-            "C:/Windows/Fonts/arial.ttf",         # Arial Regular
-            "C:/Windows/Fonts/arialbd.ttf",       # Arial Bold  
-            "C:/Windows/Fonts/ariali.ttf",        # Arial Italic
-            "C:/Windows/Fonts/arialbi.ttf",       # Arial Bold Italic
-            "C:/Windows/Fonts/calibri.ttf",       # Calibri Regular
-            "C:/Windows/Fonts/calibrib.ttf",      # Calibri Bold
-            "C:/Windows/Fonts/calibrii.ttf",      # Calibri Italic
-            "C:/Windows/Fonts/calibriz.ttf",      # Calibri Bold Italic
-        ]
-        
-        self.load_font_variants(japanese_font_paths, self.japanese_fonts, "Japanese")
-        self.load_font_variants(english_font_paths, self.english_fonts, "English")
-    
-    def setup_macos_fonts(self):
-        """macOS環境用フォント設定"""
-        # 日本語フォント
-        japanese_font_paths = [
-            "/System/Library/Fonts/Hiragino Sans GB.ttc",
-            "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc",
-            "/System/Library/Fonts/ヒラギノ角ゴシック W6.ttc",
-            "/Library/Fonts/NotoSansCJK-Regular.ttc",
-        ]
-        
-        # 英数字フォント
-        english_font_paths = [
-            "/System/Library/Fonts/Arial.ttf",
-            "/System/Library/Fonts/Arial Bold.ttf",
-            "/System/Library/Fonts/Arial Italic.ttf",
-            "/System/Library/Fonts/Arial Bold Italic.ttf",
-            "/System/Library/Fonts/Helvetica.ttc",
-            "/System/Library/Fonts/Helvetica Neue.ttc",
-        ]
-        
-        self.load_font_variants(japanese_font_paths, self.japanese_fonts, "Japanese")
-        self.load_font_variants(english_font_paths, self.english_fonts, "English")
+    フォントは常にファイルパスから開く（FreeTypeがファイルをメモリマップするため、
+    フォントデータはページキャッシュ上の同じページを全プロセスで共有する）。
+    fork前に生成したフェイスやキャッシュはコピーオンライトで共有される。
+    """
+    try:
+        if hasattr(generator, 'warm_up'):
+            generator.warm_up()
+    except Exception as e:
+        print(f"Warm-up before fork failed: {e}")
     
-    def setup_fallback_fonts(self):
-        """フォールバック設定（最終手段）"""
-        print("Using fallback font configuration")
-        try:
-            default_font = ImageFont.load_default()
-            self.japanese_fonts = {
-                'regular': default_font,
-                'bold': default_font,
-                'italic': default_font,
-                'bold_italic': default_font
-            }
-            self.english_fonts = {
-                'regular': default_font,
-                'bold': default_font,
-                'italic': default_font,
-                'bold_italic': default_font
-            }
-        except Exception as e:
-            print(f"Even fallback fonts failed: {e}")
-            self.japanese_fonts = self.english_fonts = {}
+    # 既存オブジェクトをGCの走査対象から外し、共有ページへの書き込み（コピー）を防ぐ
+    gc.freeze()
+
+def init_render_worker():
+    """レンダリング用ワーカープロセスの初期化（フォント検出済みの生成器を温める）"""
+    try:
+        if hasattr(generator, 'warm_up'):
+            generator.warm_up()
+        print(f"Render worker {os.getpid()} ready")
+    except Exception as e:
+        print(f"Render worker warm-up failed: {e}")
+
+class RenderBackendBusy(Exception):
+    """レンダリングの待ち行列が満杯"""
+    pass
+
+class ProcessRenderBackend:
+    """画像生成とPNGエンコードをワーカープロセスのプールで実行する（GIL回避）"""
+    def __init__(self, processes, queue_depth, timeout, render_timeout):
+        self.processes = processes
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.render_timeout = render_timeout
+        self.slots = threading.BoundedSemaphore(processes + queue_depth)
+        self.executor = None
+        self.executor_pid = None
+        self.lock = threading.Lock()
     
-    def load_font_variants(self, font_paths, font_dict, font_type):
-        """フォントのバリエーション（Regular, Bold, Italic, BoldItalic）を読み込み"""
-        loaded_fonts = []
-        
-        for font_path in font_paths:
-            try:
-                if os.path.exists(font_path):
-                    # フォントファイルをテスト読み込み
-                    test_font = ImageFont.truetype(font_path, 20)
-                    test_font.getbbox("Test日本語")  # 日本語テスト
-                    loaded_fonts.append(font_path)
-                    print(f"✓ {font_type} font loaded: {font_path}")
-            except Exception as e:
-                print(f"✗ {font_type} font failed: {font_path} - {e}")
-                continue
-        
-        if loaded_fonts:
-            # 最初に見つかったフォントを使用（通常はRegular）
-            primary_font = loaded_fonts[0]
-            
-            # バリエーションを設定
-            font_dict['regular'] = primary_font
-            
-            # Bold系フォントを探す
-            bold_font = None
-            for font_path in loaded_fonts:
-                if any(keyword in font_path.lower() for keyword in ['bold', 'bd', 'b.ttf', 'w6', 'w7']):
-                    bold_font = font_path
-                    break
-            font_dict['bold'] = bold_font or primary_font
-            
-            # Italic系フォントを探す
-            italic_font = None
-            for font_path in loaded_fonts:
-                if any(keyword in font_path.lower() for keyword in ['italic', 'oblique', 'i.ttf']):
-                    italic_font = font_path
-                    break
-            font_dict['italic'] = italic_font or primary_font
-            
-            # BoldItalic系フォントを探す
-            bold_italic_font = None
-            for font_path in loaded_fonts:
-                if any(keyword in font_path.lower() for keyword in ['bolditalic', 'boldobl', 'bi.ttf', 'z.ttf']):
-                    bold_italic_font = font_path
-                    break
-            font_dict['bold_italic'] = bold_italic_font or font_dict['bold']
-            
-            print(f"{font_type} font variants configured:")
-            for variant, path in font_dict.items():
-                print(f"  {variant}: {path}")
-        else:
-            print(f"No {font_type} fonts found, using default")
-            try:
-                default_font = ImageFont.load_default()
-                font_dict.update({
-                    'regular': default_font,
-                    'bold': default_font,
-                    'italic': default_font,
-                    'bold_italic': default_font
-                })
-            except:
-                font_dict.clear()
-    
-    def get_font(self, size, bold=False, italic=False, japanese=False):
+    def get_executor(self):
         """
-        フォントを取得
-        Args:
-            size: フォントサイズ
-            bold: 太字フラグ
-            italic: 斜体フラグ
-            japanese: 日本語フラグ（TrueならjапaneseテキJavanesee用フォント使用）
+        プールを遅延生成する（gunicornのfork後に各ワーカーで作るため）
+        リクエスト処理スレッドから作る（壊れたプールの作り直しを含む）ので、forkではなくforkserverで起動する。
+        forkすると他のスレッドが持っていたロック（キャッシュ・メトリクス等）を持ったままの子プロセスができ、
+        最初の描画でデッドロックし得る。子プロセスはappを読み込み直す（フォントはマニフェストから読むので軽い）。
         """
-        # フォント辞書を選択
-        font_dict = self.japanese_fonts if japanese else self.english_fonts
-        
-        # バリエーションを決定
-        if bold and italic:
-            variant = 'bold_italic'
-        elif bold:
-            variant = 'bold'
-        elif italic:
-            variant = 'italic'
-        else:
-            variant = 'regular'
-        
-        # フォントパスを取得
-        font_path = font_dict.get(variant)
-        if not font_path:
-            print(f"Font variant {variant} not found, using regular")
-            font_path = font_dict.get('regular')
-        
-        # フォントオブジェクトを作成
-        if font_path and isinstance(font_path, str):
-            try:
-                return ImageFont.truetype(font_path, size)
-            except Exception as e:
-                print(f"Error loading font {font_path}: {e}")
-        
-        # フォールバック
-        if isinstance(font_path, ImageFont.ImageFont):
-            return font_path
-        
-        # 最終フォールバック
-        try:
-            return ImageFont.load_default()
-        except:
-            return None
-    
-    def has_japanese_chars(self, text):
-        """文字列に日本語文字が含まれているかチェック"""
-        for char in text:
-            if ord(char) > 127:  # 基本的なASCII範囲外
-                if any([
-                    0x3040 <= ord(char) <= 0x309F,  # ひらがな
-                    0x30A0 <= ord(char) <= 0x30FF,  # カタカナ
-                    0x4E00 <= ord(char) <= 0x9FAF,  # 漢字
-                ]):
-                    return True
-        return False
-    
-    def draw_text_with_font_selection(self, draw, text, position, size, fill, bold=False, italic=False):
-        """テキストの内容に応じて適切なフォントを選択して描画（プレイヤー名専用）"""
+        with self.lock:
+            if self.executor is None or self.executor_pid != os.getpid():
+                self.executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                    mp_context=multiprocessing.get_context('forkserver'),
+                                                    initializer=init_render_worker)
+                self.executor_pid = os.getpid()
+            return self.executor
+    
+    def render(self, player1, player2, scores, match_type, output_format='png', level=None,
+               animated=False, theme=None):
+        """空きを待ってワーカーで生成し、エンコード済みのバイト列を返す"""
+        if not self.slots.acquire(timeout=self.timeout):
+            raise RenderBackendBusy("レンダリングの待ち行列が満杯です。")
         try:
-            # 日本語文字が含まれているかチェック
-            use_japanese_font = self.has_japanese_chars(text)
+            executor = self.get_executor()
+            try:
+                future = executor.submit(encode_match_image, player1, player2,
+                                         list(scores), match_type, output_format, level,
+                                         animated, theme)
+                return future.result(timeout=self.render_timeout)
+            except FutureTimeoutError:
+                future.cancel()
+                raise RenderBackendBusy("画像の生成がタイムアウトしました。")
+            except BrokenProcessPool:
+                # ワーカーが異常終了したプールは使えないため作り直し、このリクエストは同じプロセスで生成する
+                print("Render worker pool is broken; recreating it")
+                self.discard_executor(executor)
+                return encode_match_image(player1, player2, scores, match_type, output_format, level,
+                                          animated, theme)
+        finally:
+            self.slots.release()
+    
+    def discard_executor(self, executor):
+        """壊れたプールを捨てる（次のリクエストで新しいプールを作る、既に作り直されていれば何もしない）"""
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+# プロセスプールの設定（RENDER_PROCESSES=0ならリクエスト処理スレッド内で生成）
+RENDER_PROCESSES = int(os.environ.get('RENDER_PROCESSES', 0))
+RENDER_QUEUE_DEPTH = int(os.environ.get('RENDER_QUEUE_DEPTH', 16))
+RENDER_QUEUE_TIMEOUT = float(os.environ.get('RENDER_QUEUE_TIMEOUT', 30))
+RENDER_TIMEOUT = float(os.environ.get('RENDER_TIMEOUT', 20))  # ワーカーでの生成1回の上限（秒）
+
+render_backend = None
+if RENDER_PROCESSES > 0:
+    render_backend = ProcessRenderBackend(RENDER_PROCESSES, RENDER_QUEUE_DEPTH, RENDER_QUEUE_TIMEOUT,
+                                          RENDER_TIMEOUT)
+    print(f"Process render backend enabled: {RENDER_PROCESSES} processes, queue depth {RENDER_QUEUE_DEPTH}")
+
+def render_match_image(player1, player2, scores, match_type, output_format='png', level=None,
+                       animated=False, theme=None):
+    """試合結果の画像を生成（結果キャッシュ経由）し、(ETag, バイト列) を返す"""
+    # 同じ試合内容・テーマ・出力形式なら同じETagになる
+    etag = result_cache_key(player1, player2, scores, match_type, output_format, level,
+                            animated=animated, theme=theme)
+    
+    image_bytes = result_cache.lookup(etag)
+    if image_bytes is None:
+        image_bytes = render_and_store(etag, player1, player2, scores, match_type, output_format, level,
+                                       animated, theme)
+    
+    return etag, image_bytes
+
+def render_and_store(etag, player1, player2, scores, match_type, output_format='png', level=None,
+                     animated=False, theme=None):
+    """キャッシュに無かった画像を生成して結果キャッシュに登録する（検索済みの呼び出し元用）"""
+    if render_backend is not None:
+        start = time.perf_counter()
+        image_bytes = render_backend.render(player1, player2, scores, match_type,
+                                            output_format, level, animated, theme)
+        metrics.add('render_backend', time.perf_counter() - start)
+    else:
+        image_bytes = encode_match_image(player1, player2, scores, match_type,
+                                         output_format, level, animated, theme)
+    result_cache.store(etag, image_bytes)
+    return image_bytes
+
+class Overloaded(Exception):
+    """混雑のため受け付けない（HTTPステータスとRetry-Afterの秒数付き）"""
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class AdmissionTicket:
+    """描画枠1つ分（処理が終わったらreleaseする）"""
+    def __init__(self, controller, degraded):
+        self.controller = controller
+        self.degraded = degraded  # Trueなら軽量な描画で返す
+        self.start = time.perf_counter()
+        self.released = False
+    
+    def release(self):
+        """描画枠を返す（2回目以降は何もしない、別スレッドから呼ばれても1回だけ返す）"""
+        with self.controller.condition:
+            if self.released:
+                return
+            self.released = True
+            self.controller.release(time.perf_counter() - self.start)
+
+class AdmissionController:
+    """
+    同時に描画するリクエスト数の上限と、上限付きの待ち行列（ワーカープロセスごと）
+    待ち行列が満杯なら429、締め切りまでに描画を始められない見込みなら503を返させ、
+    待ち行列が閾値を超えたら軽量な描画に切り替えさせる
+    """
+    def __init__(self, limit, queue_size, timeout, degrade_depth):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.degrade_depth = degrade_depth  # 0なら軽量な描画は使わない
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.service_time = 0.05  # 1件あたりの処理時間（秒、指数移動平均）
+        self.admitted = 0
+        self.degraded = 0
+        self.rejected = 0
+        self.timed_out = 0
+    
+    def estimated_wait(self):
+        """今から並んだ場合に描画を始められるまでの推定秒数"""
+        return (self.waiting + 1) / self.limit * self.service_time
+    
+    def retry_after(self):
+        """今の待ち行列が捌けるまでの推定秒数（Retry-After用、最低1秒）"""
+        return max(1, math.ceil((self.active + self.waiting) / self.limit * self.service_time))
+    
+    def admit(self, deadline=None):
+        """描画枠を確保してAdmissionTicketを返す（確保できなければOverloaded）"""
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        with self.condition:
+            if self.active < self.limit and self.waiting == 0:
+                self.active += 1
+                self.admitted += 1
+                return AdmissionTicket(self, False)
             
-            # フォントを取得
-            font = self.get_font(size, bold=bold, italic=italic, japanese=use_japanese_font)
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                raise Overloaded("混雑しています。しばらくしてから再度お試しください。", 429,
+                                 self.retry_after())
+            if time.monotonic() + self.estimated_wait() > deadline:
+                self.rejected += 1
+                raise Overloaded("混雑のため時間内に生成できません。", 503, self.retry_after())
             
-            if font:
-                draw.text(position, text, fill=fill, font=font)
-            else:
-                # フォント取得に失敗した場合
-                draw.text(position, text, fill=fill)
-                
-        except Exception as e:
-            print(f"Text drawing failed: {e}")
+            degraded = 0 < self.degrade_depth <= self.waiting
+            self.waiting += 1
             try:
-                # 最終フォールバック
-                draw.text(position, text, fill=fill)
-            except Exception as e2:
-                print(f"Final fallback also failed: {e2}")
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        raise Overloaded("混雑のため時間内に生成できません。", 503, self.retry_after())
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            
+            self.active += 1
+            self.admitted += 1
+            self.degraded += int(degraded)
+            return AdmissionTicket(self, degraded)
     
-    def draw_english_text(self, draw, text, position, size, fill, bold=False, italic=False):
-        """英語テキスト専用描画メソッド（確実に英語フォントを使用）"""
-        try:
-            # 強制的に英語フォントを使用
-            font = self.get_font(size, bold=bold, italic=italic, japanese=False)
+    def release(self, elapsed):
+        with self.condition:
+            self.active -= 1
+            self.service_time = 0.8 * self.service_time + 0.2 * elapsed
+            self.condition.notify()
+    
+    def stats(self):
+        with self.condition:
+            return {
+                'limit': self.limit,
+                'queue_size': self.queue_size,
+                'active': self.active,
+                'waiting': self.waiting,
+                'service_time': round(self.service_time, 4),
+                'admitted': self.admitted,
+                'degraded': self.degraded,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+            }
+
+# /generate・/generate/sizes・/preview・/batchの受付制御（ADMISSION_LIMIT=0なら無効）
+# 上限はワーカープロセスごと。描画はCPU律速なので既定はCPU数
+ADMISSION_LIMIT = int(os.environ.get('ADMISSION_LIMIT', os.cpu_count() or 2))
+ADMISSION_QUEUE = int(os.environ.get('ADMISSION_QUEUE', 16))
+ADMISSION_TIMEOUT = float(os.environ.get('ADMISSION_TIMEOUT', 10))  # gunicornのtimeoutより短くする
+ADMISSION_DEGRADE_DEPTH = int(os.environ.get('ADMISSION_DEGRADE_DEPTH', 8))
+
+# 混雑時の軽量な描画（静止画・パレットPNG・最速の圧縮）
+DEGRADED_FORMAT = 'png-palette'
+DEGRADED_LEVEL = 1
+
+admission = None
+if ADMISSION_LIMIT > 0:
+    admission = AdmissionController(ADMISSION_LIMIT, ADMISSION_QUEUE, ADMISSION_TIMEOUT,
+                                    ADMISSION_DEGRADE_DEPTH)
+
+def overloaded_response(error):
+    return f"エラー: {error}", error.status, {'Retry-After': str(error.retry_after)}
+
+# PNGをエンコードしながら送信するか（Content-Lengthは付かない）
+STREAM_RESPONSES = os.environ.get('STREAM_RESPONSES', '1') == '1'
+# 送信しながら結果キャッシュ用に残すPNGの上限（超えたらそれ以降は残さず、キャッシュもしない）
+STREAM_CACHE_MAX_BYTES = int(os.environ.get('STREAM_CACHE_MAX_BYTES', 512 * 1024))
+
+def stream_png_response(img, etag, level, mimetype, download_name, on_close=None):
+    """
+    描画済みのキャンバスをPNGにエンコードしながら送るレスポンス
+    送信したバイト列は STREAM_CACHE_MAX_BYTES までは残して結果キャッシュに登録し、超えたら残すのをやめる
+    （通常の画像はキャッシュされ、大きな画像はエンコード結果全体をメモリに持たない）
+    on_close（描画枠の返却など）とキャンバスの返却は、送信の完了を待たずエンコードが終わった時点で行う。
+    本文を読まれずに閉じられた・途中で中断された場合はレスポンスを閉じるときに行う（どちらの場合も1回だけ）。
+    """
+    # エンコーダーの作成と引数の検証はここで行い、失敗すればステータスを送る前に例外にする
+    png_chunks = iter_png(img, level)
+    memory = metrics.defer_memory()
+    canvas_bytes = image_nbytes(img)
+    memory.allocate(canvas_bytes)
+    tee = io.BytesIO()  # 送信済みのバイト列（getvalue()はコピーせずに返す）
+    completed = False
+    released = False
+    release_lock = threading.Lock()
+    
+    def release():
+        """キャンバスと描画枠を返す（2回目以降は何もしない）"""
+        nonlocal released
+        with release_lock:
+            if released:
+                return
+            released = True
+        if hasattr(generator, 'release_canvas'):
+            generator.release_canvas(img)
+        memory.free(canvas_bytes)
+        if on_close is not None:
+            on_close()
+    
+    def generate():
+        nonlocal tee, completed
+        encode_seconds = 0.0
+        chunks = iter(png_chunks)
+        
+        def next_chunk():
+            nonlocal encode_seconds
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            encode_seconds += time.perf_counter() - start
+            return chunk
+        
+        # 1チャンク先読みし、最後のチャンクを送る前にエンコードの終了を検出する
+        # （iter_pngは最後のチャンクをエンコード完了後に返すので、遅いクライアントへの最後の送信中に
+        # 描画枠とキャンバスを持ち続けない。大きな画像では途中のチャンクの送信はエンコードと交互に行う）
+        pending = next_chunk()
+        while pending is not None:
+            following = next_chunk()
+            if following is None:
+                # after_requestは本文の送信前に終わっているため、エンコード時間はここで記録する
+                metrics.observe_deferred('encode', encode_seconds)
+                release()
             
-            if font:
-                draw.text(position, text, fill=fill, font=font)
-            else:
-                # フォント取得に失敗した場合
-                draw.text(position, text, fill=fill)
-                
-        except Exception as e:
-            print(f"English text drawing failed: {e}")
-            try:
-                # 最終フォールバック
-                draw.text(position, text, fill=fill)
-            except Exception as e2:
-                print(f"Final fallback also failed: {e2}")
-    
-    def create_image(self, player1, player2, scores, match_type):
-        # 画像とDrawオブジェクトを作成
-        img = Image.new('RGB', (self.width, self.height), self.bg_color)
-        draw = ImageDraw.Draw(img)
-        
-        # タイトル（英語）- 斜体 ★英語フォント強制使用
-        title_text = "Game Result"
-        try:
-            # テキスト幅を計算（フォント取得できない場合のフォールバック）
-            title_font = self.get_font(80, bold=True, italic=True, japanese=False)
-            if title_font:
-                title_bbox = draw.textbbox((0, 0), title_text, font=title_font)
-                title_width = title_bbox[2] - title_bbox[0]
+            memory.allocate(len(pending))
+            if tee is not None and tee.tell() + len(pending) <= STREAM_CACHE_MAX_BYTES:
+                tee.write(pending)
+                yield pending
             else:
-                title_width = len(title_text) * 40  # フォールバック計算
-        except:
-            title_width = len(title_text) * 40
-        
-        self.draw_english_text(draw, title_text, 
-                             ((self.width - title_width) // 2, 80), 
-                             80, self.primary_color, bold=True, italic=True)
-        
-        # 勝者を判定
-        player1_wins = sum(1 for score in scores if score[0] > score[1])
-        player2_wins = sum(1 for score in scores if score[1] > score[0])
-        winner = player1 if player1_wins > player2_wins else player2
-        
-        # プレイヤー名と各セットのスコアを左右に配置
-        left_x = 230
-        right_x = self.width - 230
-        score_left_x = 420
-        score_right_x = self.width - 420
-        
-        # WIN表示 - 斜体 ★英語フォント強制使用
-        win_text = "WIN"
-        try:
-            win_font = self.get_font(60, bold=True, italic=True, japanese=False)
-            if win_font:
-                win_bbox = draw.textbbox((0, 0), win_text, font=win_font)
-                win_width = win_bbox[2] - win_bbox[0]
-            else:
-                win_width = len(win_text) * 30
-        except:
-            win_width = len(win_text) * 30
-        
-        if winner == player1:
-            self.draw_english_text(draw, win_text, 
-                                 (left_x - win_width // 2, 230), 
-                                 60, self.accent_color, bold=True, italic=True)
-        else:
-            self.draw_english_text(draw, win_text, 
-                                 (right_x - win_width // 2, 230), 
-                                 60, self.accent_color, bold=True, italic=True)
-        
-        # プレイヤー名を配置 - タイトルと同じサイズ（80） ★プレイヤー名のみ自動判定フォント使用
-        player_y = 300
-        
-        # プレイヤー1（左側）
-        try:
-            name_font = self.get_font(80, bold=True, japanese=self.has_japanese_chars(player1))
-            if name_font:
-                player1_bbox = draw.textbbox((0, 0), player1, font=name_font)
-                player1_width = player1_bbox[2] - player1_bbox[0]
-            else:
-                player1_width = len(player1) * 40
-        except:
-            player1_width = len(player1) * 40
-        
-        self.draw_text_with_font_selection(draw, player1, 
-                                         (left_x - player1_width // 2, player_y), 
-                                         80, self.secondary_color, bold=True)
-        
-        # プレイヤー2（右側）
+                if tee is not None:
+                    # 上限を超えたので残していた分を捨て、以降はチャンクごとに送って解放する
+                    memory.free(tee.tell())
+                    tee = None
+                yield pending
+                memory.free(len(pending))
+            pending = following
+        completed = True
+    
+    def close():
+        """
+        WSGIサーバーがレスポンスを閉じたときの後始末（本文の送信前に閉じられた場合も呼ばれる）
+        ジェネレーターの中の処理は最初のチャンクを送る前に閉じられると実行されないため、ここでも返却する
+        """
+        # 途中で閉じられた場合はエンコーダーを先に片付けてからキャンバスを返す
+        if hasattr(png_chunks, 'close'):
+            png_chunks.close()
+        release()
+        metrics.observe_peak_bytes('generate_image', memory.peak)
+        if completed and tee is not None:
+            result_cache.store(etag, tee.getvalue())
+    
+    response = Response(generate(), mimetype=mimetype)
+    # 本文のイテレーターを閉じた後に呼ばれる（エンコード中のキャンバスを先に返却することはない）
+    response.call_on_close(close)
+    response.set_etag(etag)
+    # send_fileと同じく、ASCII以外のファイル名はRFC 5987形式（filename*）でも送る
+    ascii_name = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+    names = {'filename': ascii_name}
+    if ascii_name != download_name:
+        names['filename*'] = f"UTF-8''{quote(download_name, safe='!#$&+-.^_`|~')}"
+    response.headers.set('Content-Disposition', 'attachment', **names)
+    return response
+
+@app.route('/generate', methods=['POST'])
+def generate_image():
+    try:
+        # フォームデータを取得
+        start = time.perf_counter()
         try:
-            name_font = self.get_font(80, bold=True, japanese=self.has_japanese_chars(player2))
-            if name_font:
-                player2_bbox = draw.textbbox((0, 0), player2, font=name_font)
-                player2_width = player2_bbox[2] - player2_bbox[0]
-            else:
-                player2_width = len(player2) * 40
-        except:
-            player2_width = len(player2) * 40
+            player1, player2, scores, match_type = parse_match_form(request.form)
+            output_format, level = parse_output_options(request.form)
+            animated = parse_animation_option(request.form, output_format)
+            theme = parse_theme_option(request.form)
+        except MatchInputError as e:
+            return f"エラー: {e}", 400
+        metrics.add('parse', time.perf_counter() - start)
+        
+        # プロファイル中はキャッシュ・ストリーミング・別プロセスを使わず、このスレッドで描画とエンコードを行う
+        profiling = g.get('profiling', False)
+        
+        # 条件付きリクエストで一致すれば再生成せずに304を返す
+        etag = result_cache_key(player1, player2, scores, match_type, output_format, level,
+                                animated=animated, theme=theme)
+        if not profiling and request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
         
-        self.draw_text_with_font_selection(draw, player2, 
-                                         (right_x - player2_width // 2, player_y), 
-                                         80, self.secondary_color, bold=True)
+        # ファイル名を英数字のみに変更
+        mimetype, extension, _ = OUTPUT_FORMATS[output_format]
+        safe_filename = f'GameResult_{player1}_vs_{player2}.{extension}'
+        
+        # キャッシュ済みなら混雑していても描画枠を使わずに返す
+        image_bytes = None if profiling else result_cache.lookup(etag)
+        ticket = None
+        if image_bytes is None and admission is not None:
+            start = time.perf_counter()
+            try:
+                ticket = admission.admit()
+            except Overloaded as e:
+                return overloaded_response(e)
+            metrics.add('admission', time.perf_counter() - start)
+        degraded = ticket is not None and ticket.degraded
         
-        # 「vs」をプレイヤー名の間に配置 - 斜体 ★英語フォント強制使用
-        vs_text = "vs"
         try:
-            vs_font = self.get_font(50, italic=True, japanese=False)
-            if vs_font:
-                vs_bbox = draw.textbbox((0, 0), vs_text, font=vs_font)
-                vs_width = vs_bbox[2] - vs_bbox[0]
-            else:
-                vs_width = len(vs_text) * 25
-        except:
-            vs_width = len(vs_text) * 25
-        
-        self.draw_english_text(draw, vs_text, 
-                             ((self.width - vs_width) // 2, player_y + 50), 
-                             50, self.accent_color, bold=True, italic=True)
-        
-        # 各セットのスコアの配置計算
-        num_sets = len(scores)
-        line_height = 50
-        final_y = 540
-        
-        if num_sets == 1:
-            center_set_index = 0
-        elif num_sets <= 3:
-            center_set_index = 1
-        elif num_sets <= 5:
-            center_set_index = 2
-        else:
-            center_set_index = 3
-        
-        score_start_y = final_y + 50 - (center_set_index * line_height)
-        
-        # 各セットのスコア表示 - 斜体 ★英語フォント強制使用
-        for i, (score1, score2) in enumerate(scores):
-            y_pos = score_start_y + i * line_height
+            if degraded:
+                # 待ち行列が長いときは軽量な描画で返す（ブラウザ等にはキャッシュさせない）
+                output_format, level, animated = DEGRADED_FORMAT, DEGRADED_LEVEL, False
+                if hasattr(generator, 'theme'):
+                    theme = (theme or generator.theme).without_effects()
+                mimetype, extension, _ = OUTPUT_FORMATS[output_format]
+                safe_filename = f'GameResult_{player1}_vs_{player2}.{extension}'
             
-            # 左側のスコア
-            score1_text = str(score1)
-            try:
-                detail_font = self.get_font(35, italic=True, japanese=False)
-                if detail_font:
-                    score1_bbox = draw.textbbox((0, 0), score1_text, font=detail_font)
-                    score1_width = score1_bbox[2] - score1_bbox[0]
-                else:
-                    score1_width = len(score1_text) * 20
-            except:
-                score1_width = len(score1_text) * 20
+            # 同一プロセスで描画するPNGは、エンコードしながら送信する（描画枠は送信後に解放）
+            if STREAM_RESPONSES and output_format == 'png' and not animated and render_backend is None \
+                    and image_bytes is None and not profiling:
+                start = time.perf_counter()
+                img = generator.create_image(player1, player2, scores, match_type, theme)
+                metrics.add('render', time.perf_counter() - start)
+                response = stream_png_response(img, etag, level, mimetype, safe_filename,
+                                               on_close=ticket.release if ticket else None)
+                ticket = None
+                return response
             
-            self.draw_english_text(draw, score1_text, 
-                                 (score_left_x - score1_width // 2, y_pos), 
-                                 35, self.secondary_color, italic=True)
-            
-            # 右側のスコア
-            score2_text = str(score2)
+            if image_bytes is None and profiling:
+                image_bytes = encode_match_image(player1, player2, scores, match_type,
+                                                 output_format, level, animated, theme)
+            elif image_bytes is None:
+                # キャッシュは検索済みなので、もう一度検索せずに生成する（ミス数を二重に数えない）
+                etag = result_cache_key(player1, player2, scores, match_type, output_format, level,
+                                        animated=animated, theme=theme)
+                try:
+                    image_bytes = render_and_store(etag, player1, player2, scores, match_type,
+                                                   output_format, level, animated, theme)
+                except RenderBackendBusy as e:
+                    return f"エラー: {e}", 503, {'Retry-After': '5'}
+        finally:
+            if ticket is not None:
+                ticket.release()
+        
+        start = time.perf_counter()
+        response = send_file(io.BytesIO(image_bytes), mimetype=mimetype, 
+                             as_attachment=True, 
+                             download_name=safe_filename,
+                             etag=etag)
+        if degraded:
+            response.headers['Cache-Control'] = 'no-store'
+            response.headers['X-Degraded'] = '1'
+        metrics.add('send_file', time.perf_counter() - start)
+        return response
+        
+    except Exception as e:
+        print(f"Error in generate_image: {e}")
+        return f"エラーが発生しました: {str(e)}", 500
+
+@app.route('/generate/sizes', methods=['POST'])
+def generate_sizes():
+    """1つのレイアウトから複数の出力サイズ（正方形・ストーリー・横長）をまとめて生成（複数ならZIP）"""
+    try:
+        player1, player2, scores, match_type = parse_match_form(request.form)
+        output_format, level = parse_output_options(request.form)
+        sizes = parse_size_options(request.form)
+        theme = parse_theme_option(request.form)
+    except MatchInputError as e:
+        return f"エラー: {e}", 400
+    
+    try:
+        etags = {size: result_cache_key(player1, player2, scores, match_type, output_format, level,
+                                        size=size, theme=theme)
+                 for size in sizes}
+        etag = hashlib.sha256(''.join(etags.values()).encode('ascii')).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+        
+        # キャッシュに無いサイズだけを1回のレイアウトから描画する
+        images = {size: result_cache.lookup(etags[size]) for size in sizes}
+        missing = [size for size, image_bytes in images.items() if image_bytes is None]
+        if missing:
+            # /generateと同じ描画枠を使う（サイズ数に関係なく1枠、軽量な描画には切り替えない）
+            ticket = None
+            if admission is not None:
+                start = time.perf_counter()
+                try:
+                    ticket = admission.admit()
+                except Overloaded as e:
+                    return overloaded_response(e)
+                metrics.add('admission', time.perf_counter() - start)
             try:
-                detail_font = self.get_font(35, italic=True, japanese=False)
-                if detail_font:
-                    score2_bbox = draw.textbbox((0, 0), score2_text, font=detail_font)
-                    score2_width = score2_bbox[2] - score2_bbox[0]
-                else:
-                    score2_width = len(score2_text) * 20
-            except:
-                score2_width = len(score2_text) * 20
-            
-            self.draw_english_text(draw, score2_text, 
-                                 (score_right_x - score2_width // 2, y_pos), 
-                                 35, self.secondary_color, italic=True)
-            
-            # 中央のハイフン
-            dash_text = "-"
+                rendered = encode_match_sizes(generator, player1, player2, scores, match_type, missing,
+                                              output_format, level, theme)
+            finally:
+                if ticket is not None:
+                    ticket.release()
+            for size, image_bytes in rendered.items():
+                result_cache.store(etags[size], image_bytes)
+            images.update(rendered)
+        
+        mimetype, extension, _ = OUTPUT_FORMATS[output_format]
+        if len(sizes) == 1:
+            response = send_file(io.BytesIO(images[sizes[0]]), mimetype=mimetype, as_attachment=True,
+                                 download_name=match_filename(player1, player2, extension, size=sizes[0]))
+        else:
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+                for size in sizes:
+                    archive.writestr(match_filename(player1, player2, extension, size=size), images[size])
+            buffer.seek(0)
+            response = send_file(buffer, mimetype='application/zip', as_attachment=True,
+                                 download_name=match_filename(player1, player2, 'zip'))
+        response.set_etag(etag)
+        return response
+    except MatchInputError as e:
+        return f"エラー: {e}", 400
+    except Exception as e:
+        print(f"Error in generate_sizes: {e}")
+        return f"エラーが発生しました: {str(e)}", 500
+
+# プレビュー画像の幅（既定）と上限
+PREVIEW_WIDTH = int(os.environ.get('PREVIEW_WIDTH', 360))
+PREVIEW_MAX_WIDTH = 540
+# プレビューの幅はこの中で最も近いものに丸める（幅ごとに背景テンプレートを作るため種類を限定する）
+PREVIEW_WIDTHS = tuple(sorted({180, 270, 360, PREVIEW_MAX_WIDTH, min(max(PREVIEW_WIDTH, 64), PREVIEW_MAX_WIDTH)}))
+
+def snap_preview_width(width):
+    return min(PREVIEW_WIDTHS, key=lambda candidate: (abs(candidate - width), candidate))
+
+@app.route('/preview', methods=['POST'])
+def preview_image():
+    """入力中のプレビュー用に低解像度のPNGを生成（ダウンロード用のフル解像度は/generate）"""
+    try:
+        player1, player2, scores, match_type = parse_match_form(request.form)
+        width = snap_preview_width(int(request.form.get('width') or PREVIEW_WIDTH))
+        theme = parse_theme_option(request.form)
+    except (MatchInputError, KeyError, ValueError) as e:
+        # 入力途中は不完全なことが多いので400を返すだけ（クライアントは前のプレビューを表示し続ける）
+        return f"エラー: {e}", 400
+    
+    try:
+        etag = result_cache_key(player1, player2, scores, match_type, 'png', 1, width, theme=theme)
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+        
+        image_bytes = result_cache.lookup(etag)
+        if image_bytes is None:
+            # /generateと同じ描画枠を使う（プレビューは小さいので軽量な描画には切り替えない）
+            ticket = None
+            if admission is not None:
+                start = time.perf_counter()
+                try:
+                    ticket = admission.admit()
+                except Overloaded as e:
+                    return overloaded_response(e)
+                metrics.add('admission', time.perf_counter() - start)
             try:
-                detail_font = self.get_font(35, italic=True, japanese=False)
-                if detail_font:
-                    dash_bbox = draw.textbbox((0, 0), dash_text, font=detail_font)
-                    dash_width = dash_bbox[2] - dash_bbox[0]
-                else:
-                    dash_width = 15
-            except:
-                dash_width = 15
-            
-            self.draw_english_text(draw, dash_text, 
-                                 ((self.width - dash_width) // 2, y_pos), 
-                                 35, self.secondary_color, italic=True)
-        
-        # 最終スコア（セット数）- 斜体 ★英語フォント強制使用
-        final_score1 = str(player1_wins)
+                start = time.perf_counter()
+                img = generator.create_preview(player1, player2, scores, match_type, width, theme)
+                rendered = time.perf_counter()
+                # 小さい画像なので圧縮より速度を優先する
+                image_bytes = encode_image(img, 'png', 1)
+                if hasattr(generator, 'release_canvas'):
+                    generator.release_canvas(img)
+                metrics.add('render', rendered - start)
+                metrics.add('encode', time.perf_counter() - rendered)
+            finally:
+                if ticket is not None:
+                    ticket.release()
+            result_cache.store(etag, image_bytes)
+        
+        response = Response(image_bytes, mimetype='image/png')
+        response.set_etag(etag)
+        return response
+    except Exception as e:
+        print(f"Error in preview_image: {e}")
+        return f"エラーが発生しました: {str(e)}", 500
+
+# バッチ生成の設定
+BATCH_MAX_ROWS = int(os.environ.get('BATCH_MAX_ROWS', 1000))
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', os.cpu_count() or 2))
+BATCH_ADMISSION_ATTEMPTS = int(os.environ.get('BATCH_ADMISSION_ATTEMPTS', 3))
+
+class ZipStreamBuffer:
+    """ZipFileの書き込み先（書かれた分を取り出してすぐ送信するためのバッファ）"""
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        """溜まったデータを取り出して空にする"""
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def read_batch_rows(req):
+    """バッチリクエストからJSONまたはCSVの行を読み込む"""
+    if req.is_json:
+        payload = req.get_json()
+        rows = payload.get('matches') if isinstance(payload, dict) else payload
+        if not isinstance(rows, list):
+            raise MatchInputError("JSONは試合のリスト、または {\"matches\": [...]} で送信してください。")
+        return rows
+    
+    # CSV（ファイルアップロードまたはリクエストボディ）
+    upload = req.files.get('file')
+    text = upload.read().decode('utf-8-sig') if upload else req.get_data(as_text=True)
+    if not text.strip():
+        raise MatchInputError("試合データがありません。")
+    return list(csv.DictReader(io.StringIO(text)))
+
+def render_batch_row(index, row):
+    """バッチの1行を生成し、(ファイル名, 画像バイト列) を返す"""
+    if not isinstance(row, dict):
+        raise MatchInputError("行の形式が不正です。")
+    player1, player2, scores, match_type = parse_match_form(row)
+    output_format, level = parse_output_options(row)
+    theme = parse_theme_option(row)
+    etag = result_cache_key(player1, player2, scores, match_type, output_format, level, theme=theme)
+    image_bytes = result_cache.lookup(etag)
+    if image_bytes is None:
+        # /generateと同じ描画枠を使う（バッチの並列数の分だけCPUを占有しないように）
+        ticket = admit_batch_row()
         try:
-            score_font = self.get_font(120, bold=True, italic=True, japanese=False)
-            if score_font:
-                final_bbox1 = draw.textbbox((0, 0), final_score1, font=score_font)
-                final_width1 = final_bbox1[2] - final_bbox1[0]
-            else:
-                final_width1 = len(final_score1) * 70
-        except:
-            final_width1 = len(final_score1) * 70
-        
-        self.draw_english_text(draw, final_score1, 
-                             (left_x - final_width1 // 2, final_y), 
-                             120, self.primary_color, bold=True, italic=True)
-        
-        final_score2 = str(player2_wins)
+            image_bytes = render_and_store(etag, player1, player2, scores, match_type, output_format,
+                                           level, theme=theme)
+        finally:
+            if ticket is not None:
+                ticket.release()
+    extension = OUTPUT_FORMATS[output_format][1]
+    return match_filename(player1, player2, extension, index), image_bytes
+
+def admit_batch_row():
+    """
+    バッチの1行分の描画枠を確保する（受付制御が無効ならNone）
+    混雑で断られたらRetry-Afterの秒数だけ待って数回やり直し、それでも駄目ならその行をエラーにする
+    軽量な描画には切り替えない
+    """
+    if admission is None:
+        return None
+    for attempt in range(BATCH_ADMISSION_ATTEMPTS):
         try:
-            score_font = self.get_font(120, bold=True, italic=True, japanese=False)
-            if score_font:
-                final_bbox2 = draw.textbbox((0, 0), final_score2, font=score_font)
-                final_width2 = final_bbox2[2] - final_bbox2[0]
-            else:
-                final_width2 = len(final_score2) * 70
-        except:
-            final_width2 = len(final_score2) * 70
-        
-        self.draw_english_text(draw, final_score2, 
-                             (right_x - final_width2 // 2, final_y), 
-                             120, self.primary_color, bold=True, italic=True)
-        
-        # 装飾的な要素
-        draw.rectangle([100, 180, self.width - 100, 185], fill=self.primary_color)
-        draw.rectangle([100, self.height - 150, self.width - 100, self.height - 145], 
-                      fill=self.primary_color)
+            return admission.admit()
+        except Overloaded as e:
+            if attempt == BATCH_ADMISSION_ATTEMPTS - 1:
+                raise
+            time.sleep(e.retry_after)
+
+def stream_batch_zip(rows):
+    """行を並列に生成し、完成したものから順にZIPとして送信する"""
+    buffer = ZipStreamBuffer()
+    manifest = []
+    
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive, \
+            ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        pending = {}
+        row_iter = iter(enumerate(rows))
+        
+        # 同時に保持する画像数を制限しながら投入する
+        def submit_next():
+            item = next(row_iter, None)
+            if item is None:
+                return False
+            index, row = item
+            pending[executor.submit(render_batch_row, index, row)] = index
+            return True
+        
+        for _ in range(BATCH_WORKERS * 2):
+            if not submit_next():
+                break
+        
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    filename, image_bytes = future.result()
+                    archive.writestr(filename, image_bytes)
+                    manifest.append({'row': index + 1, 'status': 'ok', 'file': filename})
+                except Exception as e:
+                    print(f"Error in batch row {index + 1}: {e}")
+                    manifest.append({'row': index + 1, 'status': 'error', 'error': str(e)})
+                submit_next()
+            
+            data = buffer.drain()
+            if data:
+                yield data
         
-        # フッターテキスト ★英語フォント強制使用
-        footer_text = "Table Tennis Result Generator"
+        # 各行の結果一覧（行番号順）
+        manifest.sort(key=lambda entry: entry['row'])
+        archive.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+    
+    yield buffer.drain()
+
+@app.route('/batch', methods=['POST'])
+def generate_batch():
+    """複数試合の画像をZIPでまとめて生成（大会用）"""
+    try:
+        rows = read_batch_rows(request)
+    except MatchInputError as e:
+        return f"エラー: {e}", 400
+    except Exception as e:
+        print(f"Error in generate_batch: {e}")
+        return f"エラー: 試合データを読み込めませんでした: {str(e)}", 400
+    
+    if not rows:
+        return "エラー: 試合データがありません。", 400
+    if len(rows) > BATCH_MAX_ROWS:
+        return f"エラー: 一度に生成できるのは{BATCH_MAX_ROWS}試合までです。", 400
+    
+    return Response(stream_with_context(stream_batch_zip(rows)),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=GameResults.zip'})
+
+# リーグ戦の試合結果ストア（SQLite、全ワーカーで共有）
+LEAGUE_DB_PATH = os.environ.get(
+    'LEAGUE_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'league.db'))
+STANDINGS_IMAGE_ROWS = 11  # 順位表画像に表示する最大人数（フッターと重ならない範囲）
+standings_store = None
+standings_lock = threading.Lock()
+
+def get_standings_store():
+    """ストアを初回利用時に開く（使わない環境ではDBファイルを作らない）"""
+    global standings_store
+    with standings_lock:
+        if standings_store is None:
+            standings_store = StandingsStore(LEAGUE_DB_PATH)
+        return standings_store
+
+@app.route('/league/<season>/matches', methods=['POST'])
+def add_league_matches(season):
+    """試合結果を登録（フォーム1件、またはバッチと同じJSON/CSV形式の複数件）"""
+    try:
+        if request.form and 'player1' in request.form:
+            rows = [request.form]
+        else:
+            rows = read_batch_rows(request)
+    except MatchInputError as e:
+        return f"エラー: {e}", 400
+    except Exception as e:
+        return f"エラー: 試合データを読み込めませんでした: {str(e)}", 400
+    
+    matches = []
+    errors = []
+    for index, row in enumerate(rows):
         try:
-            footer_font = self.get_font(30, japanese=False)
-            if footer_font:
-                footer_bbox = draw.textbbox((0, 0), footer_text, font=footer_font)
-                footer_width = footer_bbox[2] - footer_bbox[0]
-            else:
-                footer_width = len(footer_text) * 15
-        except:
-            footer_width = len(footer_text) * 15
-        
-        self.draw_english_text(draw, footer_text, 
-                             ((self.width - footer_width) // 2, self.height - 90), 
-                             30, self.secondary_color)
-        
-        return img
-
-# グローバルインスタンス（エラーハンドリング付き）
-try:
-    generator = TableTennisImageGenerator()
-    print("Table Tennis Image Generator initialized successfully")
-except Exception as e:
-    print(f"Critical Error: Generator initialization failed: {e}")
-    # 完全なフォールバック
-    class EmergencyGenerator:
-        def create_image(self, player1, player2, scores, match_type):
-            img = Image.new('RGB', (1080, 1080), (255, 255, 255))
-            draw = ImageDraw.Draw(img)
-            
-            # 基本的なテキスト描画（フォント無し）
-            draw.text((540, 200), "Game Result", fill=(0, 0, 0), anchor="mm")
-            draw.text((270, 400), player1, fill=(0, 0, 0), anchor="mm")
-            draw.text((810, 400), player2, fill=(0, 0, 0), anchor="mm")
-            draw.text((540, 400), "vs", fill=(255, 0, 0), anchor="mm")
-            
-            player1_wins = sum(1 for score in scores if score[0] > score[1])
-            player2_wins = sum(1 for score in scores if score[1] > score[0])
-            
-            draw.text((270, 600), str(player1_wins), fill=(0, 0, 0), anchor="mm")
-            draw.text((810, 600), str(player2_wins), fill=(0, 0, 0), anchor="mm")
-            
-            return img
+            if not isinstance(row, dict) and not hasattr(row, 'get'):
+                raise MatchInputError("行の形式が不正です。")
+            player1, player2, scores, _ = parse_match_form(row)
+            matches.append((player1, player2, scores, row.get('match_id') or None))
+        except Exception as e:
+            errors.append({'row': index + 1, 'error': str(e)})
     
-    generator = EmergencyGenerator()
+    added = get_standings_store().add_matches(season, matches)
+    return jsonify({
+        'season': season,
+        'added': added,
+        'duplicates': len(matches) - added,
+        'errors': errors,
+    })
 
-@app.route('/')
-def index():
-    return render_template('index.html')
+@app.route('/league/<season>/standings')
+def league_standings(season):
+    """順位表（JSON）"""
+    store = get_standings_store()
+    return jsonify({
+        'season': season,
+        'matches': store.match_count(season),
+        'standings': store.standings(season, request.args.get('limit', type=int)),
+    })
 
-@app.route('/generate', methods=['POST'])
-def generate_image():
+@app.route('/league/<season>/standings.<extension>')
+def league_standings_image(season, extension):
+    """順位表の画像（上位STANDINGS_IMAGE_ROWS人）"""
+    formats = {info[1]: name for name, info in OUTPUT_FORMATS.items() if name not in ('png-palette', 'svg')}
+    output_format = formats.get(extension)
+    if output_format is None:
+        return f"エラー: 未対応の出力形式です: {extension}", 404
+    
     try:
-        # フォームデータを取得
-        player1 = request.form['player1']
-        player2 = request.form['player2']
-        match_type = request.form['match_type']
-        
-        # スコアを取得
-        scores = []
-        max_sets = int(match_type.replace('セットマッチ', ''))
-        
-        for i in range(max_sets):
-            score1_key = f'set{i+1}_score1'
-            score2_key = f'set{i+1}_score2'
-            
-            if score1_key in request.form and score2_key in request.form:
-                score1 = request.form[score1_key]
-                score2 = request.form[score2_key]
-                
-                if score1 and score2:
-                    scores.append((int(score1), int(score2)))
-        
-        if not scores:
-            return "エラー: 少なくとも1セットのスコアを入力してください。", 400
-        
-        # 画像を生成
-        img = generator.create_image(player1, player2, scores, match_type)
-        
-        # メモリ内のバイトストリームに保存
-        img_io = io.BytesIO()
-        img.save(img_io, 'PNG')
-        img_io.seek(0)
-        
-        # ファイル名を英数字のみに変更
-        safe_filename = f'GameResult_{player1}_vs_{player2}.png'
-        
-        return send_file(img_io, mimetype='image/png', 
-                        as_attachment=True, 
-                        download_name=safe_filename)
-        
+        standings = get_standings_store().standings(season, STANDINGS_IMAGE_ROWS)
+        img = generator.create_standings_image(f"{season} Standings", standings)
+        image_bytes = encode_image(img, output_format)
+        return Response(image_bytes, mimetype=OUTPUT_FORMATS[output_format][0])
     except Exception as e:
-        print(f"Error in generate_image: {e}")
+        print(f"Error in league_standings_image: {e}")
         return f"エラーが発生しました: {str(e)}", 500
 
+@app.route('/stats')
+def cache_stats():
+    """各キャッシュの統計情報（バジェット調整用）"""
+    stats = {
+        'font_cache': font_cache.stats(),
+        'result_cache': result_cache.stats(),
+        'request_peak_bytes': metrics.peak_bytes_stats(),
+    }
+    if hasattr(generator, 'sprite_cache'):
+        stats['sprite_cache'] = generator.sprite_cache.stats()
+    if hasattr(generator, 'background_cache'):
+        stats['background_cache'] = generator.background_cache.stats()
+    if hasattr(generator, 'canvas_pool'):
+        stats['canvas_pool'] = generator.canvas_pool.stats()
+    if admission is not None:
+        stats['admission'] = admission.stats()
+    return jsonify(stats)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """段階別の所要時間とキャッシュの統計（Prometheusテキスト形式）"""
+    lines = metrics.render()
+    caches = {'font': font_cache, 'result': result_cache}
+    if hasattr(generator, 'sprite_cache'):
+        caches['sprite'] = generator.sprite_cache
+    if hasattr(generator, 'background_cache'):
+        caches['background'] = generator.background_cache
+    cache_stats = {name: cache.stats() for name, cache in caches.items()}
+    
+    for metric, key, metric_type, help_text in (
+        ('tabletennis_cache_hits_total', 'hits', 'counter', 'Cache hits.'),
+        ('tabletennis_cache_misses_total', 'misses', 'counter', 'Cache misses.'),
+        ('tabletennis_cache_evictions_total', 'evictions', 'counter', 'Cache evictions.'),
+        ('tabletennis_cache_entries', 'size', 'gauge', 'Entries currently cached.'),
+        ('tabletennis_cache_bytes', 'bytes', 'gauge', 'Bytes currently cached.'),
+    ):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {metric_type}")
+        for name, stats in cache_stats.items():
+            lines.append(f'{metric}{{cache="{name}"}} {stats[key]}')
+    
+    if admission is not None:
+        admission_stats = admission.stats()
+        for metric, key, metric_type, help_text in (
+            ('tabletennis_admission_active', 'active', 'gauge', 'Renders currently running.'),
+            ('tabletennis_admission_waiting', 'waiting', 'gauge', 'Requests waiting for a render slot.'),
+            ('tabletennis_admission_degraded_total', 'degraded', 'counter', 'Requests served with the degraded render.'),
+            ('tabletennis_admission_rejected_total', 'rejected', 'counter', 'Requests rejected on admission.'),
+            ('tabletennis_admission_timeouts_total', 'timed_out', 'counter', 'Requests that missed their deadline while queued.'),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {metric_type}")
+            lines.append(f"{metric} {admission_stats[key]}")
+    
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+# 1リクエスト分のプロファイル（管理者用）
+# PROFILE_TOKEN を設定したときだけ /generate をラップする（未設定ならラップも追加のルートも無い）。
+# X-Profile-Token ヘッダーが一致したリクエストの呼び出しスタックを記録し、PROFILE_DIR に
+# 折りたたみ形式（flamegraph.pl / speedscope で表示可能）で保存してファイル名をレスポンスヘッダーで返す。
+# 保存するのは新しいものから PROFILE_KEEP 件まで（古いものは保存時に削除する）。
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN') or None
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 50))
+
+def profile_token_valid():
+    """X-Profile-Token ヘッダーがPROFILE_TOKENと一致するか（比較時間は内容によらない）"""
+    token = request.headers.get('X-Profile-Token', '')
+    return hmac.compare_digest(token.encode('utf-8'), PROFILE_TOKEN.encode('utf-8'))
+
+def profiled_view(view):
+    """X-Profile-Token ヘッダー付きのリクエストだけプロファイルを取るようにビューをラップする"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if 'X-Profile-Token' not in request.headers:
+            return view(*args, **kwargs)
+        if not profile_token_valid():
+            return "エラー: プロファイルのトークンが正しくありません。", 403
+        
+        g.profiling = True
+        profiler = StackProfiler()
+        profiler.start()
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        finally:
+            profiler.stop()
+        
+        filename = profiler.save(PROFILE_DIR, request.endpoint or 'unknown', keep=PROFILE_KEEP)
+        print(f"Profile saved: {os.path.join(PROFILE_DIR, filename)}")
+        response.headers['X-Profile'] = filename
+        # 記録中の時間（全呼び出しを記録するため通常の数倍かかる、段階間の比較用）
+        response.headers['X-Profile-Instrumented-Stages'] = ', '.join(
+            f'{stage};dur={seconds * 1000:.2f};desc="instrumented"'
+            for stage, seconds in profiler.stage_totals().items())
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    return wrapper
+
+if PROFILE_TOKEN is not None:
+    app.view_functions['generate_image'] = profiled_view(app.view_functions['generate_image'])
+    
+    @app.route('/profiles/<name>')
+    def download_profile(name):
+        """保存したプロファイルのダウンロード（X-Profile-Token が必要）"""
+        if not profile_token_valid():
+            return "エラー: プロファイルのトークンが正しくありません。", 403
+        return send_from_directory(PROFILE_DIR, name, mimetype='text/plain')
+    
+    print(f"Request profiling enabled: profiles are saved to {PROFILE_DIR}")
+
 # Render用のポート設定
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,164 @@
+"""
+画像生成パイプラインのマイクロベンチマーク
+
+create_image（セット数・名前の種類・フォールバックフォント別）・テーマ別の描画とPNGエンコードを
+別々に計測し、結果をJSONで出力する。基準値と比較して閾値以上遅くなっていれば終了コード1。
+テーマの効果による追加時間（classicとの差）が themes.EFFECT_BUDGET_MS を超えた場合も終了コード1。
+
+使い方:
+    python benchmarks/bench_render.py --output bench.json
+    python benchmarks/bench_render.py --baseline benchmarks/baseline.json --threshold 0.2
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from image_generator import TableTennisImageGenerator, encode_image
+from themes import EFFECT_BUDGET_MS, THEMES, effects_available
+
+SCORES = {
+    1: [(11, 7)],
+    3: [(11, 7), (9, 11), (11, 8)],
+    5: [(11, 7), (9, 11), (11, 8), (6, 11), (13, 11)],
+    7: [(11, 7), (9, 11), (11, 8), (6, 11), (13, 11), (8, 11), (11, 9)],
+}
+
+NAMES = {
+    'ascii': ("Player One", "Player Two"),
+    'japanese': ("山田 太郎", "佐藤 花子"),
+}
+
+def time_call(func, repeat, warmup):
+    """funcを繰り返し実行し、所要時間の統計（ミリ秒）を返す"""
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        'median_ms': round(statistics.median(timings), 3),
+        'mean_ms': round(statistics.mean(timings), 3),
+        'min_ms': round(min(timings), 3),
+        'max_ms': round(max(timings), 3),
+        'repeat': repeat,
+    }
+
+def fallback_generator():
+    """デフォルトフォントのみを使う生成器（フォールバック経路の計測用）"""
+    gen = TableTennisImageGenerator()
+    gen.setup_fallback_fonts()
+    return gen
+
+def run_benchmarks(repeat, warmup):
+    """全ケースを計測して {ケース名: 統計} を返す"""
+    gen = TableTennisImageGenerator()
+    results = {}
+    
+    for name_kind, (player1, player2) in NAMES.items():
+        for num_sets, scores in SCORES.items():
+            match_type = f"{num_sets}セットマッチ"
+            results[f'create_image/{name_kind}/{num_sets}set'] = time_call(
+                lambda: gen.create_image(player1, player2, scores, match_type), repeat, warmup)
+    
+    gen_fallback = fallback_generator()
+    for num_sets in (1, 7):
+        scores = SCORES[num_sets]
+        match_type = f"{num_sets}セットマッチ"
+        results[f'create_image/fallback/{num_sets}set'] = time_call(
+            lambda: gen_fallback.create_image("Player One", "Player Two", scores, match_type),
+            repeat, warmup)
+    
+    # テーマ別（効果の追加時間はclassicとの差で見る）
+    for theme_name, theme in THEMES.items():
+        results[f'themes/{theme_name}'] = time_call(
+            lambda: gen.create_image(*NAMES['japanese'], SCORES[5], "5セットマッチ", theme),
+            repeat, warmup)
+    
+    # チームカラー付き（毎回違う色の組み合わせ、背景テンプレートは色に関係なく共有される）
+    team_colors = (((37 * i) % 256, (91 * i) % 256, (53 * i) % 256) for i in itertools.count(1))
+    results['themes/night+team_colors'] = time_call(
+        lambda: gen.create_image(*NAMES['japanese'], SCORES[5], "5セットマッチ",
+                                 THEMES['night'].with_player_colors(next(team_colors), next(team_colors))),
+        repeat, warmup)
+    
+    # エンコードは生成済みの画像に対して単独で計測
+    img = gen.create_image(*NAMES['japanese'], SCORES[5], "5セットマッチ")
+    results['encode/png'] = time_call(lambda: encode_image(img, 'png'), repeat, warmup)
+    
+    return results
+
+def compare_with_baseline(results, baseline, threshold):
+    """基準値より中央値が threshold 以上遅いケースを返す"""
+    regressions = []
+    for name, stats in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        ratio = stats['median_ms'] / base['median_ms'] if base['median_ms'] else 1.0
+        if ratio > 1 + threshold:
+            regressions.append((name, base['median_ms'], stats['median_ms'], ratio))
+    return regressions
+
+def check_effect_budget(results, budget_ms):
+    """テーマの効果による追加時間（中央値のclassicとの差）が予算を超えたテーマを返す"""
+    base = results['themes/classic']['median_ms']
+    over = []
+    for name, stats in results.items():
+        if name.startswith('themes/') and stats['median_ms'] - base > budget_ms:
+            over.append((name, stats['median_ms'] - base))
+    return over
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the rendering pipeline")
+    parser.add_argument('--repeat', type=int, default=20, help="計測回数")
+    parser.add_argument('--warmup', type=int, default=3, help="計測前のウォームアップ回数")
+    parser.add_argument('--output', help="結果JSONの保存先（省略時は標準出力）")
+    parser.add_argument('--baseline', help="比較する基準値JSON")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="許容する遅延の割合（0.2 = 20%%）")
+    args = parser.parse_args()
+    
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'effects': effects_available(),
+            'effect_budget_ms': EFFECT_BUDGET_MS,
+        },
+        'results': run_benchmarks(args.repeat, args.warmup),
+    }
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    
+    over_budget = check_effect_budget(report['results'], EFFECT_BUDGET_MS)
+    for name, overhead in over_budget:
+        print(f"OVER BUDGET {name}: +{overhead:.3f}ms (budget {EFFECT_BUDGET_MS}ms)", file=sys.stderr)
+    if over_budget:
+        sys.exit(1)
+    
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(report['results'], baseline, args.threshold)
+        for name, base_ms, now_ms, ratio in regressions:
+            print(f"REGRESSION {name}: {base_ms:.3f}ms -> {now_ms:.3f}ms ({ratio:.2f}x)", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("No regressions above threshold", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+出力形式ごとのエンコード時間と出力サイズを比較する
+
+使い方:
+    python benchmarks/compare_formats.py [--repeat 10] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from image_generator import OUTPUT_FORMATS, create_generator, encode_image
+
+# 比較する (形式, 圧縮レベル) の組み合わせ
+CANDIDATES = [
+    ('png', 1), ('png', 6), ('png', 9),
+    ('png-palette', 1), ('png-palette', 6), ('png-palette', 9),
+    ('webp', 0), ('webp', 4), ('webp', 6),
+    ('jpeg', 75), ('jpeg', 85), ('jpeg', 95),
+]
+
+def compare_formats(img, repeat):
+    """各組み合わせのエンコード時間（中央値）とサイズを計測"""
+    results = []
+    for output_format, level in CANDIDATES:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            data = encode_image(img, output_format, level)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        results.append({
+            'format': output_format,
+            'level': level,
+            'mimetype': OUTPUT_FORMATS[output_format][0],
+            'bytes': len(data),
+            'encode_ms': round(timings[len(timings) // 2] * 1000, 2),
+        })
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare encode time and size per output format")
+    parser.add_argument('--repeat', type=int, default=10, help="計測回数")
+    parser.add_argument('--json', action='store_true', help="JSONで出力")
+    args = parser.parse_args()
+    
+    generator = create_generator()
+    img = generator.create_image("山田 太郎", "Player 2",
+                                 [(11, 9), (8, 11), (11, 7), (11, 13), (11, 6)], "5セットマッチ")
+    results = compare_formats(img, args.repeat)
+    
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    
+    print(f"{'format':<12} {'level':>5} {'bytes':>9} {'encode ms':>10}")
+    for result in results:
+        print(f"{result['format']:<12} {result['level']:>5} {result['bytes']:>9} {result['encode_ms']:>10}")
+
+if __name__ == '__main__':
+    main()
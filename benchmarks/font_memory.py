@@ -0,0 +1,105 @@
+"""
+ワーカー数ごとのメモリ使用量を、フォントの読み込み方式別に比較する（Linux専用）
+
+  per-worker: fork後に各ワーカーがフォントを読み込む（従来の動作）
+  shared:     fork前にprepare_for_fork()で読み込み、ワーカー間で共有する
+
+各ワーカーの RSS / PSS / Private（そのプロセス固有のメモリ）を /proc/<pid>/smaps_rollup から取得する。
+
+使い方:
+    python benchmarks/font_memory.py [--workers 1 2 4 8] [--renders 20]
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import app
+
+MATCHES = [
+    ("Player One", "山田 太郎", [(11, 7), (9, 11), (11, 8)], "3セットマッチ"),
+    ("佐藤 花子", "Player Two", [(11, 7), (9, 11), (11, 8), (6, 11), (13, 11)], "5セットマッチ"),
+]
+
+def read_memory(pid):
+    """smaps_rollupからRSS・PSS・Private（kB）を読み取る"""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(':'):
+                values[parts[0][:-1]] = int(parts[1])
+    return {
+        'rss_kb': values.get('Rss', 0),
+        'pss_kb': values.get('Pss', 0),
+        'private_kb': values.get('Private_Clean', 0) + values.get('Private_Dirty', 0),
+    }
+
+def worker(mode, renders, ready_w, done_r):
+    """子プロセス: 画像を生成してから親の計測を待つ"""
+    if mode == 'per-worker':
+        # fork後にフォントとキャッシュを作り直す
+        app.generator.setup_fonts()
+        app.font_cache.clear()
+        app.generator.background_cache.clear()
+        app.generator.sprite_cache.clear()
+        app.generator.measure_cache.clear()
+    for i in range(renders):
+        player1, player2, scores, match_type = MATCHES[i % len(MATCHES)]
+        app.encode_image(app.generator.create_image(player1, player2, scores, match_type))
+    os.write(ready_w, b'1')
+    os.read(done_r, 1)
+    os._exit(0)
+
+def measure(mode, num_workers, renders):
+    """num_workers個のワーカーをforkし、全員の生成後にメモリを計測"""
+    ready_r, ready_w = os.pipe()
+    done_r, done_w = os.pipe()
+    pids = []
+    for _ in range(num_workers):
+        pid = os.fork()
+        if pid == 0:
+            worker(mode, renders, ready_w, done_r)
+        pids.append(pid)
+    
+    for _ in pids:
+        os.read(ready_r, 1)
+    samples = [read_memory(pid) for pid in pids]
+    os.write(done_w, b'x' * len(pids))
+    for pid in pids:
+        os.waitpid(pid, 0)
+    for fd in (ready_r, ready_w, done_r, done_w):
+        os.close(fd)
+    
+    return {
+        'mode': mode,
+        'workers': num_workers,
+        'avg_rss_kb': sum(s['rss_kb'] for s in samples) // len(samples),
+        'avg_private_kb': sum(s['private_kb'] for s in samples) // len(samples),
+        'total_pss_kb': sum(s['pss_kb'] for s in samples),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-worker memory with and without shared fonts")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--renders', type=int, default=20, help="ワーカーごとの生成回数")
+    parser.add_argument('--json', action='store_true', help="JSONで出力")
+    args = parser.parse_args()
+    
+    # per-workerを先に計測する（sharedの準備で親のキャッシュが温まるため）
+    results = [measure('per-worker', n, args.renders) for n in args.workers]
+    app.prepare_for_fork()
+    results += [measure('shared', n, args.renders) for n in args.workers]
+    
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    
+    print(f"{'mode':<11} {'workers':>7} {'avg RSS kB':>11} {'avg private kB':>15} {'total PSS kB':>13}")
+    for r in results:
+        print(f"{r['mode']:<11} {r['workers']:>7} {r['avg_rss_kb']:>11} {r['avg_private_kb']:>15} {r['total_pss_kb']:>13}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+"""
+/generate の負荷試験（1台のマシン上でオフラインで実行）
+
+gunicornをワーカー数・スレッド数・ワーカークラスの組み合わせごとにローカルで起動し、
+1〜7セットマッチ・英語名/日本語名を混ぜたリクエストを同時接続数を上げながら送る。
+設定ごとにスループット・p50/p95/p99レイテンシ・エラー率・gunicorn全体のRSS（ピーク）を出力する。
+
+使い方:
+    python benchmarks/load_test.py
+    python benchmarks/load_test.py --workers 1 2 4 --threads 1 4 --worker-class sync gthread \\
+        --concurrency 1 4 16 --duration 10 --output load.json
+
+負荷をかけるクライアントも同じマシンで動くため、CPU数が少ない環境ではクライアント側が
+ボトルネックになり得る（設定間の相対比較に使う）。
+"""
+import argparse
+import http.client
+import importlib.util
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+ASCII_NAMES = ["Player One", "Player Two", "Alex Smith", "Maria Garcia", "Jan Ove", "Lee Min"]
+JAPANESE_NAMES = ["山田 太郎", "佐藤 花子", "鈴木 一郎", "高橋 美咲", "伊藤 健太", "渡辺 さくら"]
+
+# gevent / eventlet はインストールされている場合のみ使用できる
+WORKER_CLASS_MODULES = {'gevent': 'gevent', 'eventlet': 'eventlet'}
+
+def random_game(rng):
+    """1ゲーム分のスコア（11点先取、10-10以降は2点差）"""
+    if rng.random() < 0.8:
+        winner, loser = 11, rng.randint(0, 9)
+    else:
+        loser = rng.randint(10, 14)
+        winner = loser + 2
+    return (winner, loser) if rng.random() < 0.5 else (loser, winner)
+
+def random_match(rng, tag, unique):
+    """1〜7セットマッチのランダムな試合のフォームデータ"""
+    max_sets = rng.choice([1, 3, 5, 7])
+    needed = max_sets // 2 + 1
+    scores = []
+    wins = [0, 0]
+    while max(wins) < needed:
+        score = random_game(rng)
+        scores.append(score)
+        wins[0 if score[0] > score[1] else 1] += 1
+
+    names = JAPANESE_NAMES if rng.random() < 0.5 else ASCII_NAMES
+    player1, player2 = rng.sample(names, 2)
+    if unique:
+        # 結果キャッシュに当たらないよう名前を変える（描画とエンコードの負荷を計測する）
+        player1 = f"{player1} {tag}"
+
+    form = {'player1': player1, 'player2': player2, 'match_type': f"{max_sets}セットマッチ"}
+    for i, (score1, score2) in enumerate(scores, 1):
+        form[f'set{i}_score1'] = score1
+        form[f'set{i}_score2'] = score2
+    return urllib.parse.urlencode(form)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def child_pids(pid):
+    """プロセスの子プロセス（gunicornのワーカー）のPID"""
+    pids = []
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    return pids
+
+def read_rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+class RssSampler(threading.Thread):
+    """マスターと全ワーカーのRSS合計を定期的に測り、ピークを記録する（Linux専用）"""
+    def __init__(self, pid, interval=0.25):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            total = sum(read_rss_kb(pid) for pid in [self.pid] + child_pids(self.pid))
+            self.peak_kb = max(self.peak_kb, total)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak_kb
+
+class GunicornServer:
+    """gunicornをサブプロセスとして起動・停止する"""
+    def __init__(self, workers, threads, worker_class, port, timeout=60):
+        self.port = port
+        self.command = [
+            sys.executable, '-m', 'gunicorn', 'app:app',
+            '--bind', f'127.0.0.1:{port}',
+            '--workers', str(workers),
+            '--threads', str(threads),
+            '--worker-class', worker_class,
+            '--timeout', str(timeout),
+            '--log-level', 'warning',
+        ]
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(self.command, cwd=ROOT, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL)
+        self.wait_ready()
+        return self
+
+    def wait_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with code {self.process.returncode}")
+            try:
+                conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=2)
+                conn.request('GET', '/stats')
+                conn.getresponse().read()
+                conn.close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError("gunicorn did not become ready")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+def client_loop(port, bodies, deadline, latencies, errors, lock):
+    """締め切りまでリクエストを送り続ける（接続はkeep-aliveで再利用）"""
+    conn = None
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    local_latencies = []
+    local_errors = 0
+    for body in bodies:
+        if time.monotonic() >= deadline:
+            break
+        start = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            conn.request('POST', '/generate', body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                local_errors += 1
+            if response.getheader('Connection', '').lower() == 'close':
+                conn.close()
+                conn = None
+        except (OSError, http.client.HTTPException):
+            local_errors += 1
+            if conn is not None:
+                conn.close()
+            conn = None
+        local_latencies.append(time.perf_counter() - start)
+
+    if conn is not None:
+        conn.close()
+    with lock:
+        latencies.extend(local_latencies)
+        errors[0] += local_errors
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def run_level(server, concurrency, duration, seed, unique):
+    """同時接続数concurrencyでduration秒間負荷をかけ、結果を集計する"""
+    # 同じサーバーで同時接続数を変えて続けて計測するため、段階ごとに乱数と名前を変える
+    rng = random.Random(f"{seed}-{concurrency}")
+    counter = itertools.count()
+    body_lock = threading.Lock()
+
+    def bodies():
+        while True:
+            with body_lock:
+                index = next(counter)
+                body = random_match(rng, f"{concurrency}-{index}", unique)
+            yield body
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    sampler = RssSampler(server.process.pid)
+    sampler.start()
+
+    start = time.perf_counter()
+    deadline = time.monotonic() + duration
+    clients = [threading.Thread(target=client_loop,
+                                args=(server.port, bodies(), deadline, latencies, errors, lock))
+               for _ in range(concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    peak_rss_kb = sampler.stop()
+
+    latencies.sort()
+    total = len(latencies)
+
+    def ms(value):
+        return round(value * 1000, 1) if value is not None else None
+
+    return {
+        'concurrency': concurrency,
+        'requests': total,
+        'throughput_rps': round((total - errors[0]) / elapsed, 2),
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'error_rate': round(errors[0] / total, 4) if total else 0.0,
+        'peak_rss_mb': round(peak_rss_kb / 1024, 1),
+    }
+
+def worker_class_available(worker_class):
+    module = WORKER_CLASS_MODULES.get(worker_class)
+    return module is None or importlib.util.find_spec(module) is not None
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /generate under local gunicorn configurations")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--worker-class', nargs='+', default=['gthread'],
+                        help="sync / gthread（gevent・eventletはインストール済みの場合のみ）")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                        help="同時接続数（この順に上げていく）")
+    parser.add_argument('--duration', type=float, default=10, help="同時接続数ごとの計測秒数")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--allow-cache-hits', action='store_true',
+                        help="名前を変えずに送り、結果キャッシュへのヒットも含めて計測する")
+    parser.add_argument('--output', help="結果をJSONで保存するファイル")
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'config':<28}{'conc':>5}{'reqs':>7}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}"
+          f"{'err%':>7}{'rss MB':>9}")
+    worker_classes = []
+    for worker_class in args.worker_class:
+        if worker_class_available(worker_class):
+            worker_classes.append(worker_class)
+        else:
+            print(f"skip {worker_class}: not installed")
+
+    for worker_class, workers, threads in itertools.product(worker_classes, args.workers, args.threads):
+        if worker_class == 'sync' and threads > 1:
+            continue  # syncワーカーはスレッド数を使わない
+        label = f"{worker_class} w={workers} t={threads}"
+        config = {'worker_class': worker_class, 'workers': workers, 'threads': threads}
+
+        with GunicornServer(workers, threads, worker_class, free_port()) as server:
+            for concurrency in args.concurrency:
+                row = run_level(server, concurrency, args.duration, args.seed,
+                                unique=not args.allow_cache_hits)
+                results.append(dict(config, **row))
+                print(f"{label:<28}{concurrency:>5}{row['requests']:>7}{row['throughput_rps']:>9}"
+                      f"{str(row['p50_ms']):>9}{str(row['p95_ms']):>9}{str(row['p99_ms']):>9}"
+                      f"{row['error_rate'] * 100:>7.1f}{row['peak_rss_mb']:>9}", flush=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'cpu_count': os.cpu_count(), 'duration': args.duration, 'results': results},
+                      f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+試合結果画像の一括生成（コマンドライン）
+
+CSVまたはJSONL（1行1試合、/batchと同じ項目名）を読み込み、複数プロセスで画像を生成して
+出力ディレクトリに書き出す。Flaskは読み込まない。
+
+    python bulk_render.py matches.csv -o out/
+    python bulk_render.py matches.jsonl -o out/ --format webp --processes 4
+    cat matches.jsonl | python bulk_render.py - -o out/
+
+入力は1行ずつ読み、処理中の行数を制限するため、入力の大きさに関係なくメモリ使用量は一定。
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+
+from image_generator import (
+    OUTPUT_FORMATS, MatchInputError, create_generator, encode_match, match_filename,
+    parse_animation_option, parse_match_form, parse_output_options, parse_theme_option,
+)
+
+# ワーカープロセスごとの生成器（initializerで作成）
+worker_generator = None
+
+def init_worker():
+    """ワーカープロセスの初期化（フォントの検出はここで一度だけ行う）"""
+    global worker_generator
+    worker_generator = create_generator()
+
+def read_rows(stream, input_format):
+    """CSV / JSONL の行を1つずつ返す（ファイル全体は読み込まない）"""
+    if input_format == 'csv':
+        yield from csv.DictReader(stream)
+        return
+
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield line  # 不正な行はワーカーでエラーとして報告する
+
+def detect_input_format(path, stream):
+    """拡張子（標準入力なら先頭の文字）からCSVかJSONLかを判定"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.jsonl', '.ndjson', '.json'):
+        return 'jsonl'
+    if extension == '.csv':
+        return 'csv'
+
+    head = stream.buffer.peek(4) if hasattr(stream, 'buffer') else b''
+    return 'jsonl' if head.lstrip(b'\xef\xbb\xbf \t\r\n')[:1] == b'{' else 'csv'
+
+def render_row(index, row, output_dir, default_format):
+    """1行を生成してファイルに書き出し、(ファイル名, バイト数) を返す（ワーカープロセスで実行）"""
+    if not isinstance(row, dict):
+        raise MatchInputError("行の形式が不正です。")
+    if not row.get('format'):
+        row = dict(row, format=default_format)
+
+    player1, player2, scores, match_type = parse_match_form(row)
+    output_format, level = parse_output_options(row)
+    animated = parse_animation_option(row, output_format)
+    theme = parse_theme_option(row)
+    image_bytes = encode_match(worker_generator, player1, player2, scores, match_type,
+                               output_format, level, animated, theme)
+
+    filename = match_filename(player1, player2, OUTPUT_FORMATS[output_format][1], index)
+    path = os.path.join(output_dir, filename)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(image_bytes)
+    os.replace(tmp_path, path)
+    return filename, len(image_bytes)
+
+class Progress:
+    """処理件数・エラー数・速度を標準エラー出力に表示"""
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.start = time.perf_counter()
+        self.last_shown = 0
+        self.done = 0
+        self.errors = 0
+        self.bytes = 0
+
+    def update(self, size=0, error=False):
+        self.done += 1
+        self.errors += int(error)
+        self.bytes += size
+        now = time.perf_counter()
+        if self.enabled and now - self.last_shown >= 0.2:
+            self.last_shown = now
+            self.show(now)
+
+    def show(self, now, end='\r'):
+        elapsed = max(now - self.start, 1e-9)
+        print(f"{self.done} rendered ({self.errors} errors), {self.done / elapsed:.1f}/s, "
+              f"{self.bytes / 1024 / 1024:.1f} MB", end=end, file=sys.stderr, flush=True)
+
+    def finish(self):
+        self.show(time.perf_counter(), end='\n')
+
+def render_all(rows, output_dir, default_format, processes, progress):
+    """行を並列に生成し、完成したものから順に結果を表示する（処理中の行数は上限付き）"""
+    max_pending = processes * 4
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker) as executor:
+        pending = {}
+        row_iter = iter(enumerate(rows))
+
+        def submit_next():
+            item = next(row_iter, None)
+            if item is None:
+                return False
+            index, row = item
+            pending[executor.submit(render_row, index, row, output_dir, default_format)] = index
+            return True
+
+        while len(pending) < max_pending and submit_next():
+            pass
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                try:
+                    _, size = future.result()
+                    progress.update(size)
+                except Exception as e:
+                    progress.update(error=True)
+                    print(f"\nRow {index + 1}: {e}", file=sys.stderr)
+                submit_next()
+
+def main():
+    parser = argparse.ArgumentParser(description="Render table tennis result images from CSV/JSONL")
+    parser.add_argument('input', help="入力ファイル（CSV / JSONL、'-'で標準入力）")
+    parser.add_argument('-o', '--output-dir', required=True, help="画像の出力先ディレクトリ")
+    parser.add_argument('--input-format', choices=('auto', 'csv', 'jsonl'), default='auto')
+    parser.add_argument('--format', default='png', choices=sorted(OUTPUT_FORMATS),
+                        help="行にformatが無い場合の出力形式")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 2,
+                        help="生成に使うプロセス数")
+    parser.add_argument('--quiet', action='store_true', help="進捗を表示しない")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.input == '-':
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline='')
+    else:
+        stream = open(args.input, encoding='utf-8-sig', newline='')
+
+    with stream:
+        input_format = args.input_format
+        if input_format == 'auto':
+            input_format = detect_input_format(args.input, stream)
+
+        progress = Progress(enabled=not args.quiet and sys.stderr.isatty())
+        render_all(read_rows(stream, input_format), args.output_dir, args.format,
+                   max(1, args.processes), progress)
+        if not args.quiet:
+            progress.finish()
+
+    return 1 if progress.errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,16 @@
+# gunicorn設定（`gunicorn app:app` 実行時に自動で読み込まれる）
+import os
+
+# マスタープロセスでアプリを一度だけ読み込み、フォント検出済みの状態でforkする
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+def when_ready(server):
+    """ワーカー起動前にマスターでフォント・キャッシュを読み込む（fork後は各ワーカーで共有）"""
+    if not preload_app:
+        return
+    try:
+        import app
+        app.prepare_for_fork()
+        server.log.info("Fonts and generator caches loaded before forking workers")
+    except Exception as e:
+        server.log.warning(f"Generator warm-up failed: {e}")
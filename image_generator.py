@@ -0,0 +1,1861 @@
+"""
+卓球の試合結果画像の生成（レイアウト・描画・エンコード）
+
+Flaskに依存しないため、Webアプリ（app.py）とコマンドライン（bulk_render.py）の両方から使う。
+フォントの検出はインポート時ではなく create_generator() を呼んだときに行う。
+"""
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+import io
+import json
+import math
+import os
+import platform
+import struct
+import threading
+import time
+import unicodedata
+import zlib
+
+try:
+    from fontTools.pens.svgPathPen import SVGPathPen
+    from fontTools.ttLib import TTFont
+except ImportError:  # fontTools が無い環境ではSVGの文字をtext要素で出力し、収録文字は文字範囲で判定する
+    TTFont = None
+
+from themes import (
+    THEMES, apply_text_effects, effect_layers, effect_margin, effects_available, gradient_array,
+    parse_color,
+)
+
+class LRUCache:
+    """件数上限（と任意のバイト上限）付きのスレッドセーフなLRUキャッシュ（ヒット/ミス数を記録）"""
+    def __init__(self, max_size=64, max_bytes=None, sizeof=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.items = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def lookup(self, key):
+        """キーに対応する値を取得（無ければNone）"""
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return value
+    
+    def store(self, key, value):
+        """値を登録し、上限を超えた分を古い順に削除"""
+        size = self.sizeof(value)
+        with self.lock:
+            if self.max_bytes is not None and size > self.max_bytes:
+                return  # 単体で上限を超えるものはキャッシュしない
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.total_bytes -= self.sizeof(old)
+            self.items[key] = value
+            self.total_bytes += size
+            while self.items and (len(self.items) > self.max_size or
+                                  (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+                _, evicted = self.items.popitem(last=False)
+                self.total_bytes -= self.sizeof(evicted)
+                self.evictions += 1
+    
+    def get_or_create(self, key, factory):
+        """キーに対応する値を取得（無ければfactory()で生成して登録）"""
+        value = self.lookup(key)
+        if value is not None:
+            return value
+        
+        # 生成処理はロック外で行う（例外は呼び出し元で処理）
+        value = factory()
+        self.store(key, value)
+        return value
+    
+    def stats(self):
+        """ヒット/ミス数などの統計情報を返す"""
+        with self.lock:
+            return {
+                'size': len(self.items),
+                'max_size': self.max_size,
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+    
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+class FontCache(LRUCache):
+    """プロセス全体で共有するFreeTypeフォントオブジェクトのキャッシュ"""
+    def get(self, font_path, size, variant):
+        """(パス, サイズ, バリエーション) をキーにフォントを取得（無ければ読み込み）"""
+        return self.get_or_create((font_path, size, variant),
+                                  lambda: ImageFont.truetype(font_path, size))
+
+class TextSprite:
+    """プリレンダリング済みテキスト（RGBA画像・描画オフセット・幅）"""
+    def __init__(self, image, offset, width):
+        self.image = image
+        self.offset = offset
+        self.width = width
+
+class GlyphOutline:
+    """SVG出力用のグリフ（パスデータと送り幅、フォント単位）"""
+    def __init__(self, glyph_id, path, advance, units_per_em):
+        self.glyph_id = glyph_id
+        self.path = path
+        self.advance = advance
+        self.units_per_em = units_per_em
+
+# SVG出力用: fontToolsで開いたフォントとグリフのアウトラインのキャッシュ
+outline_font_cache = LRUCache(max_size=8)
+glyph_outline_cache = LRUCache(max_size=int(os.environ.get('GLYPH_CACHE_SIZE', 4096)))
+outline_lock = threading.Lock()
+
+def get_glyph_outline(font_path, char):
+    """文字のアウトラインを取得（(フォントパス, 文字) ごとに一度だけ抽出）"""
+    def extract():
+        # fontToolsの遅延読み込みはスレッドセーフではないためロックする
+        with outline_lock:
+            font = outline_font_cache.get_or_create(
+                font_path, lambda: TTFont(font_path, fontNumber=0, lazy=True))
+            glyph_name = (font.getBestCmap() or {}).get(ord(char), '.notdef')
+            glyph_set = font.getGlyphSet()
+            pen = SVGPathPen(glyph_set)
+            glyph_set[glyph_name].draw(pen)
+            return GlyphOutline(font.getGlyphID(glyph_name), pen.getCommands(),
+                                glyph_set[glyph_name].width, font['head'].unitsPerEm)
+    return glyph_outline_cache.get_or_create((font_path, char), extract)
+
+def read_font_coverage(font_path):
+    """フォントのcmapから収録文字のコードポイント集合を読む（読めなければNone）"""
+    if TTFont is None or not isinstance(font_path, str):
+        return None
+    try:
+        with outline_lock:
+            font = outline_font_cache.get_or_create(
+                font_path, lambda: TTFont(font_path, fontNumber=0, lazy=True))
+            return frozenset(font.getBestCmap() or ())
+    except Exception as e:
+        print(f"Font coverage could not be read: {font_path} - {e}")
+        return None
+
+def is_cjk_char(char):
+    """日本語フォントが必要な文字か（cmapを読めない場合の文字範囲による判定）"""
+    code = ord(char)
+    return (0x3040 <= code <= 0x30FF or  # ひらがな・カタカナ
+            0x4E00 <= code <= 0x9FFF or  # 漢字
+            0xAC00 <= code <= 0xD7AF or  # ハングル
+            0xFF00 <= code <= 0xFFEF)    # 全角英数・半角カナ
+
+def is_neutral_char(char):
+    """前後の文字と同じフォントで描く文字（空白・数字・記号・結合文字）"""
+    return not char.isalpha() or unicodedata.category(char) == 'Mn'
+
+def svg_color(color):
+    """(R, G, B) をSVGの色指定に変換"""
+    return '#%02x%02x%02x' % tuple(color[:3])
+
+class TextRun:
+    """配置済みのテキスト（描画位置とフォント指定）"""
+    def __init__(self, text, position, size, fill, bold=False, italic=False, japanese=False, sprite=False,
+                 region='body'):
+        self.text = text
+        self.position = position
+        self.size = size
+        self.fill = fill
+        self.bold = bold
+        self.italic = italic
+        self.japanese = japanese
+        self.sprite = sprite  # Trueならプリレンダリング済みスプライトを貼り付ける
+        self.region = region  # 出力サイズに合わせるときの帯（CanvasSpec.REGIONSのいずれか）
+
+# 一度のリクエストでまとめて生成できる出力サイズ（名前 → (幅, 高さ)）
+OUTPUT_SIZES = {
+    'square': (1080, 1080),
+    'story': (1080, 1920),
+    'landscape': (1200, 675),
+}
+
+class CanvasSpec:
+    """
+    デザイン座標（1080×1080）のレイアウトを出力サイズに配置する変換
+    拡大率は幅・高さの小さい方に合わせ、横方向は中央に置く。
+    縦に余る高さ（ストーリーの1080×1920など）は帯の間に均等に配り、ヘッダーは上端・フッターは下端に揃え、
+    名前の帯とスコアの帯をその間に広げる（上下に余白だけができるレターボックスにはしない）。
+    横長（1200×675）は高さで拡大率が決まるので縦の余りは無く、左右に背景の余白ができる。
+    """
+    # 帯と、縦に余った高さのうちその帯の上に入れる割合（上から順）
+    REGIONS = {'header': 0, 'names': 1 / 3, 'body': 1 / 2, 'scores': 2 / 3, 'footer': 1}
+    
+    def __init__(self, name, width, height, design_width=1080, design_height=1080):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.scale = min(width / design_width, height / design_height)
+        self.offset_x = (width - design_width * self.scale) / 2
+        extra = height - design_height * self.scale
+        self.offset_y = {region: extra * share for region, share in self.REGIONS.items()}
+        self.identity = (width, height) == (design_width, design_height)
+    
+    def point(self, x, y, region='body'):
+        """デザイン座標の点を出力サイズの座標に変換"""
+        return (round(x * self.scale + self.offset_x), round(y * self.scale + self.offset_y[region]))
+
+class MatchLayout:
+    """1試合分のレイアウト（描画前の配置計画）"""
+    def __init__(self, width, height, runs, player1_wins, player2_wins, winner, steps=None, theme=None):
+        self.width = width
+        self.height = height
+        self.runs = runs
+        self.player1_wins = player1_wins
+        self.player2_wins = player2_wins
+        self.winner = winner
+        # アニメーションで順に表示する要素のグループ（名前 → 各セット → 最終スコアとWIN）
+        self.steps = steps if steps is not None else [runs]
+        self.theme = theme  # 背景・効果の描画に使うテーマ
+
+# フォントキャッシュ（上限は環境変数で変更可能）
+font_cache = FontCache(max_size=int(os.environ.get('FONT_CACHE_SIZE', 64)))
+
+class MemoryAccount:
+    """1リクエストで確保している大きなバッファ（キャンバス・エンコード結果）のバイト数と最大値"""
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self.deferred = False  # Trueならレスポンス送信後に呼び出し側が記録する（ストリーミング）
+    
+    def allocate(self, nbytes):
+        self.current += nbytes
+        self.peak = max(self.peak, self.current)
+    
+    def free(self, nbytes):
+        self.current -= nbytes
+
+def image_nbytes(img):
+    """画像のピクセルデータのバイト数"""
+    return img.width * img.height * len(img.getbands())
+
+class StageMetrics:
+    """処理段階ごとの所要時間ヒストグラム（Prometheus形式で出力）"""
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    BYTE_BUCKETS = tuple(2 ** power * 1024 for power in range(6, 16))  # 64KB〜32MB
+    
+    def __init__(self):
+        self.histograms = {}  # stage -> [バケットごとの件数, 合計秒数, 件数]
+        self.request_counts = {}  # (endpoint, status) -> 件数
+        self.peak_bytes = {}  # endpoint -> [バケットごとの件数, 合計バイト数, 件数, 最大値, 直近の値]
+        self.lock = threading.Lock()
+        self.local = threading.local()
+    
+    def begin(self):
+        """リクエスト単位の計測を開始"""
+        self.local.timings = {}
+        self.local.memory = MemoryAccount()
+    
+    def allocate(self, nbytes):
+        """現在のリクエストで確保したバッファのバイト数を記録（リクエスト外では何もしない）"""
+        memory = getattr(self.local, 'memory', None)
+        if memory is not None:
+            memory.allocate(nbytes)
+    
+    def free(self, nbytes):
+        memory = getattr(self.local, 'memory', None)
+        if memory is not None:
+            memory.free(nbytes)
+    
+    def current_memory(self):
+        """現在のリクエストのMemoryAccount（リクエスト外ならNone）"""
+        return getattr(self.local, 'memory', None)
+    
+    def defer_memory(self):
+        """レスポンス本文の送信中も計測を続けるため、MemoryAccountを呼び出し側に渡す"""
+        memory = self.current_memory() or MemoryAccount()
+        memory.deferred = True
+        return memory
+    
+    def observe_peak_bytes(self, endpoint, nbytes):
+        """リクエストごとの最大確保バイト数を記録"""
+        with self.lock:
+            entry = self.peak_bytes.get(endpoint)
+            if entry is None:
+                entry = self.peak_bytes[endpoint] = [[0] * len(self.BYTE_BUCKETS), 0, 0, 0, 0]
+            for i, bound in enumerate(self.BYTE_BUCKETS):
+                if nbytes <= bound:
+                    entry[0][i] += 1
+            entry[1] += nbytes
+            entry[2] += 1
+            entry[3] = max(entry[3], nbytes)
+            entry[4] = nbytes
+    
+    def peak_bytes_stats(self):
+        with self.lock:
+            return {endpoint: {'count': count, 'max': maximum, 'last': last,
+                               'mean': total // count if count else 0}
+                    for endpoint, (_, total, count, maximum, last) in self.peak_bytes.items()}
+    
+    def add(self, stage, seconds):
+        """現在のリクエストに段階の所要時間を加算（リクエスト外では何もしない）"""
+        timings = getattr(self.local, 'timings', None)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+    
+    def finish(self, endpoint, status):
+        """リクエストの計測を終了してヒストグラムに反映し、段階別の所要時間を返す"""
+        timings = getattr(self.local, 'timings', None) or {}
+        memory = getattr(self.local, 'memory', None)
+        self.local.timings = None
+        self.local.memory = None
+        if memory is not None and not memory.deferred and memory.peak:
+            self.observe_peak_bytes(endpoint, memory.peak)
+        with self.lock:
+            for stage, seconds in timings.items():
+                self.observe(stage, seconds)
+            key = (endpoint, status)
+            self.request_counts[key] = self.request_counts.get(key, 0) + 1
+        return timings
+    
+    def observe_deferred(self, stage, seconds):
+        """リクエストの計測を終えた後（レスポンス本文の送信中など）に段階の所要時間を記録"""
+        with self.lock:
+            self.observe(stage, seconds)
+    
+    def observe(self, stage, seconds):
+        """ヒストグラムに1件記録（ロック取得済みで呼ぶこと）"""
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = [[0] * len(self.BUCKETS), 0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+    
+    def render(self):
+        """Prometheusテキスト形式のヒストグラムとリクエスト数"""
+        lines = [
+            "# HELP tabletennis_stage_duration_seconds Time spent per request in each processing stage.",
+            "# TYPE tabletennis_stage_duration_seconds histogram",
+        ]
+        with self.lock:
+            for stage, (buckets, total, count) in sorted(self.histograms.items()):
+                for bound, bucket_count in zip(self.BUCKETS, buckets):
+                    lines.append(f'tabletennis_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {bucket_count}')
+                lines.append(f'tabletennis_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                lines.append(f'tabletennis_stage_duration_seconds_sum{{stage="{stage}"}} {total}')
+                lines.append(f'tabletennis_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+            lines.append("# HELP tabletennis_request_peak_bytes Peak bytes of image buffers held by a request.")
+            lines.append("# TYPE tabletennis_request_peak_bytes histogram")
+            for endpoint, (buckets, total, count, _, _) in sorted(self.peak_bytes.items()):
+                for bound, bucket_count in zip(self.BYTE_BUCKETS, buckets):
+                    lines.append(f'tabletennis_request_peak_bytes_bucket{{endpoint="{endpoint}",le="{bound}"}} {bucket_count}')
+                lines.append(f'tabletennis_request_peak_bytes_bucket{{endpoint="{endpoint}",le="+Inf"}} {count}')
+                lines.append(f'tabletennis_request_peak_bytes_sum{{endpoint="{endpoint}"}} {total}')
+                lines.append(f'tabletennis_request_peak_bytes_count{{endpoint="{endpoint}"}} {count}')
+            lines.append("# HELP tabletennis_requests_total Requests handled by endpoint and status.")
+            lines.append("# TYPE tabletennis_requests_total counter")
+            for (endpoint, status), count in sorted(self.request_counts.items()):
+                lines.append(f'tabletennis_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+        return lines
+
+# 段階別の計測（プロセス単位）
+metrics = StageMetrics()
+
+# フォント検出結果のマニフェスト（ワーカー起動時のフォント探索を省略するため）
+FONT_MANIFEST_PATH = os.environ.get(
+    'FONT_MANIFEST_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.font_manifest.json'))
+FONT_MANIFEST_VERSION = 1
+
+# 出力形式: 名前 -> (MIMEタイプ, 拡張子, 既定の圧縮レベル)
+OUTPUT_FORMATS = {
+    'png': ('image/png', 'png', 6),
+    'png-palette': ('image/png', 'png', 6),
+    'webp': ('image/webp', 'webp', 4),
+    'jpeg': ('image/jpeg', 'jpg', 85),
+    'svg': ('image/svg+xml', 'svg', None),  # ベクター出力（ラスタライズしない）
+    'gif': ('image/gif', 'gif', None),
+}
+
+# 形式ごとの圧縮レベルの範囲（png系: zlibレベル、webp: 可逆圧縮のmethod、jpeg: 品質、無い形式はlevelを使わない）
+LEVEL_RANGES = {
+    'png': (0, 9),
+    'png-palette': (0, 9),
+    'webp': (0, 6),
+    'jpeg': (1, 95),
+}
+
+# アニメーション出力に対応する形式（pngはAPNG）と各フレームの表示時間
+ANIMATED_FORMATS = ('png', 'png-palette', 'webp', 'gif')
+ANIMATION_FRAME_MS = int(os.environ.get('ANIMATION_FRAME_MS', 600))
+ANIMATION_HOLD_MS = int(os.environ.get('ANIMATION_HOLD_MS', 3000))  # 最終フレーム
+
+# パレットPNGの色数（単色の塗り＋アンチエイリアスなので少なくて十分）
+PALETTE_COLORS = int(os.environ.get('PALETTE_COLORS', 64))
+
+# 入力の上限（1リクエストあたりの描画コストの上限を一定にする）
+MAX_NAME_LENGTH = int(os.environ.get('MAX_NAME_LENGTH', 40))
+MAX_SCORE = 99
+MATCH_SET_COUNTS = (1, 3, 5, 7)
+
+# 長い名前の自動縮小（サイズは一定刻みにして、読み込むフォントの種類を増やしすぎない）
+NAME_MAX_WIDTH = 400  # 名前1人分の列幅（中央の「vs」と画像の端に重ならない幅）
+NAME_MIN_SIZE = 40
+NAME_SIZE_STEP = 4
+ELLIPSIS = "…"
+
+def encode_image(img, output_format='png', level=None):
+    """
+    画像を指定形式でエンコードしてバイト列を返す
+    Args:
+        output_format: png / png-palette / webp / jpeg / gif
+        level: 圧縮レベル（png系: zlibレベル0-9、webp: 可逆圧縮のmethod 0-6、jpeg: 品質1-95）
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    if output_format == 'svg':
+        raise ValueError("SVG is rendered from the layout, not encoded from a raster image")
+    if level is None:
+        level = OUTPUT_FORMATS[output_format][2]
+    
+    img_io = io.BytesIO()
+    if output_format == 'png':
+        img.save(img_io, 'PNG', compress_level=level)
+    elif output_format == 'png-palette':
+        palette_img = img.quantize(colors=PALETTE_COLORS, method=Image.Quantize.FASTOCTREE)
+        palette_img.save(img_io, 'PNG', compress_level=level)
+    elif output_format == 'webp':
+        img.save(img_io, 'WEBP', lossless=True, method=level)
+    elif output_format == 'jpeg':
+        img.save(img_io, 'JPEG', quality=level)
+    elif output_format == 'gif':
+        img.quantize(colors=PALETTE_COLORS, method=Image.Quantize.FASTOCTREE).save(img_io, 'GIF')
+    return img_io.getvalue()
+
+# ストリーミング送信時のPNGの1チャンク（IDAT）あたりの最大バイト数
+PNG_STREAM_CHUNK = 64 * 1024
+
+def png_chunk(chunk_type, data):
+    """PNGチャンク（長さ・種類・データ・CRC）"""
+    return (struct.pack('>I', len(data)) + chunk_type + data +
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+def iter_png(img, level=None, chunk_size=PNG_STREAM_CHUNK):
+    """
+    PNGをエンコードしながら少しずつ返すイテレーター（エンコード結果全体をメモリに持たない）
+    出力はimg.save(..., 'PNG', compress_level=level) と同じバイト列になる
+    引数の検証とエンコーダーの作成はこの関数の呼び出し時に行い、失敗すれば最初のチャンクを返す前に例外にする
+    """
+    if img.mode != 'RGB':
+        raise ValueError(f"Streaming PNG supports RGB images only: {img.mode}")
+    if level is None:
+        level = OUTPUT_FORMATS['png'][2]
+    low, high = LEVEL_RANGES['png']
+    if not low <= level <= high:
+        raise ValueError(f"PNG compress level must be {low}-{high}: {level}")
+    
+    encoder = create_png_encoder(img, level)
+    if encoder is None:
+        # Pillowの内部APIが使えない場合はimg.saveで一度にエンコードし、分割して返す
+        data = encode_image(img, 'png', level)
+        return (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+    return iter_png_chunks(img, encoder, chunk_size)
+
+def create_png_encoder(img, level):
+    """
+    Pillowのzlibエンコーダー（PNGのフィルタ処理込み）を作成する（使えなければNone）
+    Image._getencoder / setimage は内部APIのため、requirements.txtで固定したPillowで動作を確認している
+    """
+    try:
+        encoder = Image._getencoder(img.mode, 'zip', ('RGB', False, level, -1, b''))
+        encoder.setimage(img.im, (0, 0) + img.size)
+    except (AttributeError, TypeError):
+        return None
+    return encoder
+
+def iter_png_chunks(img, encoder, chunk_size):
+    """エンコーダーの出力をIDATチャンクにしてPNG全体を返す"""
+    yield b'\x89PNG\r\n\x1a\n'
+    # 8bit RGB、圧縮方式0、フィルタ方式0、インターレース無し
+    yield png_chunk(b'IHDR', struct.pack('>IIBBBBB', img.width, img.height, 8, 2, 0, 0, 0))
+    
+    try:
+        while True:
+            _, status, data = encoder.encode(chunk_size)
+            if status < 0:
+                raise OSError(f"PNG encoder error {status}")
+            if status:
+                break
+            if data:
+                yield png_chunk(b'IDAT', data)
+    finally:
+        encoder.cleanup()
+    # 最後のIDATはエンコーダーを片付けてからIENDと一緒に返す（受け取った時点でエンコードは終わっている）
+    yield (png_chunk(b'IDAT', data) if data else b'') + png_chunk(b'IEND', b'')
+
+def encode_animation(frames, durations, output_format='png', level=None):
+    """
+    フレーム列をアニメーション画像（APNG / アニメーションWebP / GIF）にエンコード
+    
+    各形式のエンコーダーは前のフレームとの差分の矩形だけを書き出すため、
+    スコアを描き足していくフレームは変化した部分だけの小さなデータになる。
+    """
+    if output_format not in ANIMATED_FORMATS:
+        raise ValueError(f"Animation is not supported for: {output_format}")
+    if level is None:
+        level = OUTPUT_FORMATS[output_format][2]
+    
+    if output_format in ('png-palette', 'gif'):
+        # 全要素が揃った最終フレームの色で共通パレットを作る
+        # （フレームごとにパレットが変わると差分が画像全体に広がる）
+        palette_img = frames[-1].quantize(colors=PALETTE_COLORS, method=Image.Quantize.FASTOCTREE)
+        frames = [frame.quantize(palette=palette_img, dither=Image.Dither.NONE)
+                  for frame in frames[:-1]] + [palette_img]
+    
+    img_io = io.BytesIO()
+    first, rest = frames[0], frames[1:]
+    if output_format in ('png', 'png-palette'):
+        first.save(img_io, 'PNG', save_all=True, append_images=rest, duration=durations,
+                   loop=0, compress_level=level)
+    elif output_format == 'webp':
+        first.save(img_io, 'WEBP', save_all=True, append_images=rest, duration=durations,
+                   loop=0, lossless=True, method=level)
+    elif output_format == 'gif':
+        first.save(img_io, 'GIF', save_all=True, append_images=rest, duration=durations,
+                   loop=0, optimize=False)
+    return img_io.getvalue()
+
+class CanvasPool:
+    """描画用キャンバスの再利用プール（プロセスごと、保持する枚数に上限あり）"""
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self.free_canvases = []
+        self.allocated = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+    
+    def acquire(self, template):
+        """templateと同じサイズのキャンバスを取り出し、templateの内容で上書きして返す"""
+        canvas = None
+        with self.lock:
+            for i, candidate in enumerate(self.free_canvases):
+                if candidate.size == template.size and candidate.mode == template.mode:
+                    canvas = self.free_canvases.pop(i)
+                    self.reused += 1
+                    break
+            else:
+                self.allocated += 1
+        
+        if canvas is None:
+            return template.copy()
+        canvas.paste(template, (0, 0))  # 再確保せずに背景で初期化
+        return canvas
+    
+    def release(self, canvas):
+        """キャンバスを返却（上限を超える分は破棄）"""
+        with self.lock:
+            if len(self.free_canvases) < self.max_size and \
+                    all(candidate is not canvas for candidate in self.free_canvases):
+                self.free_canvases.append(canvas)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.free_canvases),
+                'max_size': self.max_size,
+                'allocated': self.allocated,
+                'reused': self.reused,
+            }
+
+# リクエストでテーマを指定しない場合のテーマ
+DEFAULT_THEME = os.environ.get('THEME', 'classic')
+
+class TableTennisImageGenerator:
+    def __init__(self):
+        self.width = 1080
+        self.height = 1080
+        # 既定のテーマ（順位表など、テーマを指定しない描画はこの配色）
+        self.theme = THEMES.get(DEFAULT_THEME, THEMES['classic'])
+        self.bg_color = self.theme.bg_color
+        self.primary_color = self.theme.primary_color
+        self.secondary_color = self.theme.secondary_color
+        self.accent_color = self.theme.accent_color
+        
+        # 静的背景テンプレートのキャッシュ（テーマ・サイズ・縮尺別、ピクセルデータのバイト数で上限管理）
+        self.background_cache = LRUCache(max_size=int(os.environ.get('BACKGROUND_CACHE_SIZE', 32)),
+                                         max_bytes=int(os.environ.get('BACKGROUND_CACHE_BYTES',
+                                                                      64 * 1024 * 1024)),
+                                         sizeof=image_nbytes)
+        
+        # 描画用キャンバスの再利用プール（毎回1080×1080のバッファを確保しない）
+        self.canvas_pool = CanvasPool(int(os.environ.get('CANVAS_POOL_SIZE', 4)))
+        
+        # スコア数字・固定ラベルのスプライトキャッシュ
+        self.sprite_cache = LRUCache(max_size=int(os.environ.get('SPRITE_CACHE_SIZE', 512)))
+        
+        # テキスト幅の測定結果キャッシュ
+        self.measure_cache = LRUCache(max_size=int(os.environ.get('MEASURE_CACHE_SIZE', 4096)))
+        
+        # フォントごとの収録文字（cmap）と、名前をフォント別の区間に分割した結果のキャッシュ
+        self.coverage_cache = {}
+        self.coverage_lock = threading.Lock()
+        self.segment_cache = LRUCache(max_size=int(os.environ.get('SEGMENT_CACHE_SIZE', 1024)))
+        
+        # 名前を列幅に収めた結果（テキスト・サイズ）のキャッシュ
+        self.fit_cache = LRUCache(max_size=int(os.environ.get('FIT_CACHE_SIZE', 1024)))
+        
+        # SVG出力時のフォントごとの識別番号（グリフIDの重複回避用）
+        self.svg_font_ids = {}
+        
+        # フォント設定を初期化
+        self.setup_fonts()
+    
+    def setup_fonts(self):
+        """OS別に最適なフォントを設定"""
+        self.japanese_fonts = {}
+        self.english_fonts = {}
+        self.probed_paths = []
+        
+        system = platform.system()
+        print(f"Detected OS: {system}")
+        
+        # 前回の検出結果が有効ならフォントファイルを開かずに再利用
+        if self.load_font_manifest(system):
+            return
+        
+        if system == "Linux":  # Render環境
+            self.setup_linux_fonts()
+        elif system == "Windows":
+            self.setup_windows_fonts()
+        elif system == "Darwin":  # macOS
+            self.setup_macos_fonts()
+        else:
+            self.setup_fallback_fonts()
+        
+        self.save_font_manifest(system)
+    
+    def file_signature(self, path):
+        """ファイルの (更新時刻, サイズ) を返す（存在しなければNone）"""
+        try:
+            stat = os.stat(path)
+            return [stat.st_mtime_ns, stat.st_size]
+        except OSError:
+            return None
+    
+    def load_font_manifest(self, system):
+        """フォント検出結果のマニフェストを読み込み、ファイルが変わっていなければ適用"""
+        try:
+            with open(FONT_MANIFEST_PATH, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        
+        if manifest.get('version') != FONT_MANIFEST_VERSION or manifest.get('system') != system:
+            return False
+        
+        # 検出時に調べた全パスの状態（存在・更新時刻・サイズ）が同じか確認
+        for path, signature in manifest.get('files', {}).items():
+            if self.file_signature(path) != signature:
+                print(f"Font manifest is stale ({path} changed), rediscovering fonts")
+                return False
+        
+        # フォントファイル以外（デフォルトフォント）はnullとして保存されている
+        def restore(font_map):
+            return {variant: path if path else ImageFont.load_default()
+                    for variant, path in font_map.items()}
+        
+        try:
+            self.japanese_fonts = restore(manifest['japanese_fonts'])
+            self.english_fonts = restore(manifest['english_fonts'])
+        except Exception as e:
+            print(f"Font manifest could not be applied: {e}")
+            self.japanese_fonts = {}
+            self.english_fonts = {}
+            return False
+        
+        print(f"✓ Font configuration loaded from manifest: {FONT_MANIFEST_PATH}")
+        return True
+    
+    def save_font_manifest(self, system):
+        """フォント検出結果と調べたファイルの状態をマニフェストに保存"""
+        def serialize(font_map):
+            return {variant: path if isinstance(path, str) else None
+                    for variant, path in font_map.items()}
+        
+        manifest = {
+            'version': FONT_MANIFEST_VERSION,
+            'system': system,
+            'japanese_fonts': serialize(self.japanese_fonts),
+            'english_fonts': serialize(self.english_fonts),
+            'files': {path: self.file_signature(path) for path in self.probed_paths},
+        }
+        try:
+            tmp_path = f"{FONT_MANIFEST_PATH}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, FONT_MANIFEST_PATH)
+        except OSError as e:
+            print(f"Font manifest could not be saved: {e}")
+    
+    def setup_linux_fonts(self):
+        """Linux環境（Render含む）用フォント設定"""
+
+        # ✅ カスタムフォントを最優先で使用
+        custom_path = os.path.join(os.path.dirname(__file__), "fonts/NotoSansCJKjp-Regular.otf")
+        self.probed_paths.append(custom_path)
+        if os.path.exists(custom_path):
+            self.japanese_fonts['regular'] = custom_path
+            self.japanese_fonts['bold'] = custom_path
+            self.japanese_fonts['italic'] = custom_path
+            self.japanese_fonts['bold_italic'] = custom_path
+            print(f"✓ Custom font loaded from: {custom_path}")
+            # 英語フォントも同時に設定
+            self.setup_english_fonts_linux()
+            return
+
+        # 日本語フォント候補（優先順）
+        japanese_font_paths = [
+            # Noto Fonts（最も信頼性が高い）
+            "/usr/share/fonts/opentype/noto/NotoSansCJKjp-Regular.otf",
+            "/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc",
+            "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+            # DejaVu系（英数字でも使用可能）
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Oblique.ttf",
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans-BoldOblique.ttf",
+            # Liberation系
+            "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+            "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
+            "/usr/share/fonts/truetype/liberation/LiberationSans-Italic.ttf",
+            "/usr/share/fonts/truetype/liberation/LiberationSans-BoldItalic.ttf",
+            # Ubuntu系（GitHub Actionsでよく使用される）
+            "/usr/share/fonts/truetype/ubuntu/Ubuntu-Regular.ttf",
+            "/usr/share/fonts/truetype/ubuntu/Ubuntu-Bold.ttf",
+            "/usr/share/fonts/truetype/ubuntu/Ubuntu-Italic.ttf",
+            "/usr/share/fonts/truetype/ubuntu/Ubuntu-BoldItalic.ttf",
+        ]
+        
+        self.load_font_variants(japanese_font_paths, self.japanese_fonts, "Japanese")
+        # 英語フォントを別途設定
+        self.setup_english_fonts_linux()
+    
+    def setup_english_fonts_linux(self):
+        """Linux環境用英語フォント設定（日本語フォントとは別に）"""
+        # 英数字専用フォント候補
+        english_font_paths = [
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans-Oblique.ttf",
+            "/usr/share/fonts/truetype/dejavu/DejaVuSans-BoldOblique.ttf",
+            "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+            "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
+            "/usr/share/fonts/truetype/liberation/LiberationSans-Italic.ttf",
+            "/usr/share/fonts/truetype/liberation/LiberationSans-BoldItalic.ttf",
+            "/usr/share/fonts/truetype/ubuntu/Ubuntu-Regular.ttf",
+            "/usr/share/fonts/truetype/ubuntu/Ubuntu-Bold.ttf",
+            "/usr/share/fonts/truetype/ubuntu/Ubuntu-Italic.ttf",
+            "/usr/share/fonts/truetype/ubuntu/Ubuntu-BoldItalic.ttf",
+        ]
+        
+        self.load_font_variants(english_font_paths, self.english_fonts, "English")
+    
+    def setup_windows_fonts(self):
+        """Windows環境用フォント設定"""
+        # 日本語フォント
+        japanese_font_paths = [
+            "C:/Windows/Fonts/msgothic.ttc",      # MS Gothic
+            "C:/Windows/Fonts/msmincho.ttc",      # MS Mincho
+            "C:/Windows/Fonts/NotoSansCJK-Regular.ttc",  # もしインストールされていれば
+            "C:/Windows/Fonts/yugothm.ttc",       # Yu Gothic Medium
+            "C:/Windows/Fonts/yugothb.ttc",       # Yu Gothic Bold
+        ]
+        
+        # 英数字フォント
+        english_font_paths = [
+            "C:/Windows/Fonts/arial.ttf",         # Arial Regular
+            "C:/Windows/Fonts/arialbd.ttf",       # Arial Bold  
+            "C:/Windows/Fonts/ariali.ttf",        # Arial Italic
+            "C:/Windows/Fonts/arialbi.ttf",       # Arial Bold Italic
+            "C:/Windows/Fonts/calibri.ttf",       # Calibri Regular
+            "C:/Windows/Fonts/calibrib.ttf",      # Calibri Bold
+            "C:/Windows/Fonts/calibrii.ttf",      # Calibri Italic
+            "C:/Windows/Fonts/calibriz.ttf",      # Calibri Bold Italic
+        ]
+        
+        self.load_font_variants(japanese_font_paths, self.japanese_fonts, "Japanese")
+        self.load_font_variants(english_font_paths, self.english_fonts, "English")
+    
+    def setup_macos_fonts(self):
+        """macOS環境用フォント設定"""
+        # 日本語フォント
+        japanese_font_paths = [
+            "/System/Library/Fonts/Hiragino Sans GB.ttc",
+            "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc",
+            "/System/Library/Fonts/ヒラギノ角ゴシック W6.ttc",
+            "/Library/Fonts/NotoSansCJK-Regular.ttc",
+        ]
+        
+        # 英数字フォント
+        english_font_paths = [
+            "/System/Library/Fonts/Arial.ttf",
+            "/System/Library/Fonts/Arial Bold.ttf",
+            "/System/Library/Fonts/Arial Italic.ttf",
+            "/System/Library/Fonts/Arial Bold Italic.ttf",
+            "/System/Library/Fonts/Helvetica.ttc",
+            "/System/Library/Fonts/Helvetica Neue.ttc",
+        ]
+        
+        self.load_font_variants(japanese_font_paths, self.japanese_fonts, "Japanese")
+        self.load_font_variants(english_font_paths, self.english_fonts, "English")
+    
+    def setup_fallback_fonts(self):
+        """フォールバック設定（最終手段）"""
+        print("Using fallback font configuration")
+        try:
+            default_font = ImageFont.load_default()
+            self.japanese_fonts = {
+                'regular': default_font,
+                'bold': default_font,
+                'italic': default_font,
+                'bold_italic': default_font
+            }
+            self.english_fonts = {
+                'regular': default_font,
+                'bold': default_font,
+                'italic': default_font,
+                'bold_italic': default_font
+            }
+        except Exception as e:
+            print(f"Even fallback fonts failed: {e}")
+            self.japanese_fonts = self.english_fonts = {}
+    
+    def load_font_variants(self, font_paths, font_dict, font_type):
+        """フォントのバリエーション（Regular, Bold, Italic, BoldItalic）を読み込み"""
+        loaded_fonts = []
+        
+        for font_path in font_paths:
+            self.probed_paths.append(font_path)
+            try:
+                if os.path.exists(font_path):
+                    # フォントファイルをテスト読み込み
+                    test_font = ImageFont.truetype(font_path, 20)
+                    test_font.getbbox("Test日本語")  # 日本語テスト
+                    loaded_fonts.append(font_path)
+                    print(f"✓ {font_type} font loaded: {font_path}")
+            except Exception as e:
+                print(f"✗ {font_type} font failed: {font_path} - {e}")
+                continue
+        
+        if loaded_fonts:
+            # 最初に見つかったフォントを使用（通常はRegular）
+            primary_font = loaded_fonts[0]
+            
+            # バリエーションを設定
+            font_dict['regular'] = primary_font
+            
+            # Bold系フォントを探す
+            bold_font = None
+            for font_path in loaded_fonts:
+                if any(keyword in font_path.lower() for keyword in ['bold', 'bd', 'b.ttf', 'w6', 'w7']):
+                    bold_font = font_path
+                    break
+            font_dict['bold'] = bold_font or primary_font
+            
+            # Italic系フォントを探す
+            italic_font = None
+            for font_path in loaded_fonts:
+                if any(keyword in font_path.lower() for keyword in ['italic', 'oblique', 'i.ttf']):
+                    italic_font = font_path
+                    break
+            font_dict['italic'] = italic_font or primary_font
+            
+            # BoldItalic系フォントを探す
+            bold_italic_font = None
+            for font_path in loaded_fonts:
+                if any(keyword in font_path.lower() for keyword in ['bolditalic', 'boldobl', 'bi.ttf', 'z.ttf']):
+                    bold_italic_font = font_path
+                    break
+            font_dict['bold_italic'] = bold_italic_font or font_dict['bold']
+            
+            print(f"{font_type} font variants configured:")
+            for variant, path in font_dict.items():
+                print(f"  {variant}: {path}")
+        else:
+            print(f"No {font_type} fonts found, using default")
+            try:
+                default_font = ImageFont.load_default()
+                font_dict.update({
+                    'regular': default_font,
+                    'bold': default_font,
+                    'italic': default_font,
+                    'bold_italic': default_font
+                })
+            except:
+                font_dict.clear()
+    
+    def get_variant(self, bold=False, italic=False):
+        """太字・斜体フラグからフォントバリエーション名を決定"""
+        if bold and italic:
+            return 'bold_italic'
+        elif bold:
+            return 'bold'
+        elif italic:
+            return 'italic'
+        return 'regular'
+    
+    def get_font_path(self, bold=False, italic=False, japanese=False):
+        """フォントファイルのパス（デフォルトフォントの場合はフォントオブジェクト）を取得"""
+        # フォント辞書を選択
+        font_dict = self.japanese_fonts if japanese else self.english_fonts
+        
+        # フォントパスを取得
+        variant = self.get_variant(bold, italic)
+        font_path = font_dict.get(variant)
+        if not font_path:
+            print(f"Font variant {variant} not found, using regular")
+            font_path = font_dict.get('regular')
+        return font_path
+    
+    def get_font(self, size, bold=False, italic=False, japanese=False):
+        """
+        フォントを取得
+        Args:
+            size: フォントサイズ
+            bold: 太字フラグ
+            italic: 斜体フラグ
+            japanese: 日本語フラグ（TrueならjапaneseテキJavanesee用フォント使用）
+        """
+        # バリエーションとフォントパスを決定
+        variant = self.get_variant(bold, italic)
+        font_path = self.get_font_path(bold=bold, italic=italic, japanese=japanese)
+        
+        # フォントオブジェクトを取得（キャッシュ経由）
+        if font_path and isinstance(font_path, str):
+            try:
+                start = time.perf_counter()
+                font = font_cache.get(font_path, size, variant)
+                metrics.add('font_lookup', time.perf_counter() - start)
+                return font
+            except Exception as e:
+                print(f"Error loading font {font_path}: {e}")
+        
+        # フォールバック
+        if isinstance(font_path, ImageFont.ImageFont):
+            return font_path
+        
+        # 最終フォールバック
+        try:
+            return ImageFont.load_default()
+        except:
+            return None
+    
+    def get_font_coverage(self, font_path):
+        """フォントの収録文字の集合（フォントごとに一度だけcmapを読む、不明ならNone）"""
+        key = font_path if isinstance(font_path, str) else id(font_path)
+        if key not in self.coverage_cache:
+            coverage = read_font_coverage(font_path)
+            with self.coverage_lock:
+                self.coverage_cache[key] = coverage
+        return self.coverage_cache[key]
+    
+    def font_covers(self, font_path, char, japanese):
+        """フォントがその文字を描けるか"""
+        coverage = self.get_font_coverage(font_path)
+        if coverage is None:
+            # cmapを読めない場合は従来どおり文字範囲で判定
+            return japanese or not is_cjk_char(char)
+        return ord(char) in coverage
+    
+    def split_text(self, text, bold=False, italic=False):
+        """文字ごとに描けるフォント（英語 → 日本語の優先順）を選び、同じフォントが続く区間にまとめる"""
+        candidates = [(False, self.get_font_path(bold=bold, italic=italic, japanese=False))]
+        japanese_path = self.get_font_path(bold=bold, italic=italic, japanese=True)
+        if japanese_path != candidates[0][1]:
+            candidates.append((True, japanese_path))
+        
+        segments = []  # [japanese, 文字のリスト]
+        for char in text:
+            current = segments[-1] if segments else None
+            if current and is_neutral_char(char):
+                # 空白・数字・記号は描ける限り直前の区間に含める
+                if self.font_covers(candidates[current[0]][1], char, current[0]):
+                    current[1].append(char)
+                    continue
+            
+            japanese = next((flag for flag, path in candidates
+                             if self.font_covers(path, char, flag)),
+                            current[0] if current else candidates[0][0])
+            if current and current[0] == japanese:
+                current[1].append(char)
+            else:
+                segments.append([japanese, [char]])
+        
+        return tuple((''.join(chars), japanese) for japanese, chars in segments)
+    
+    def segment_text(self, text, bold=False, italic=False):
+        """テキストを (部分文字列, 日本語フォントか) の区間に分割（結果はキャッシュ）"""
+        key = (text, self.get_variant(bold, italic))
+        return self.segment_cache.get_or_create(key, lambda: self.split_text(text, bold, italic))
+    
+    def render_sprite(self, text, size, fill, bold=False, italic=False):
+        """英語フォントでテキストを描画したRGBAスプライトを作成"""
+        font = self.get_font(size, bold=bold, italic=italic, japanese=False)
+        if font is None:
+            raise ValueError(f"No font available for sprite: {text}")
+        
+        left, top, right, bottom = font.getbbox(text)
+        mask = Image.new('L', (max(right - left, 1), max(bottom - top, 1)), 0)
+        ImageDraw.Draw(mask).text((-left, -top), text, fill=255, font=font)
+        
+        sprite = Image.new('RGBA', mask.size, tuple(fill) + (0,))
+        sprite.putalpha(mask)
+        return TextSprite(sprite, (left, top), right - left)
+    
+    def get_sprite(self, text, size, fill, bold=False, italic=False):
+        """(テキスト, バリエーション, サイズ, 色) をキーにスプライトを取得"""
+        key = (text, self.get_variant(bold, italic), size, tuple(fill))
+        return self.sprite_cache.get_or_create(
+            key, lambda: self.render_sprite(text, size, fill, bold, italic))
+    
+    def get_theme_key(self, theme=None):
+        """結果画像のキャッシュキーに含めるテーマのキー（チームカラーとキャンバスサイズを含む）"""
+        return (self.width, self.height) + (theme or self.theme).key()
+    
+    def get_background_key(self, theme=None):
+        """背景テンプレートのキャッシュキー（チームカラーが違っても同じテンプレートを使う）"""
+        return (self.width, self.height) + (theme or self.theme).background_key()
+    
+    def layout_static(self, theme=None):
+        """
+        リクエストごとに変化しない要素（タイトル・装飾・vs・フッター）の配置
+        これらは背景テンプレートに描くため、名前・スコアより下になる（元の実装ではvs・装飾の線・フッターが
+        名前・スコアの上に描かれていた）。名前は列幅（NAME_MAX_WIDTH）に収め、スコアは装飾の線の内側に
+        配置するので、通常の入力では重ならず見た目は変わらない。
+        """
+        theme = theme or self.theme
+        runs = []
+        
+        # タイトル（英語）- 斜体 ★英語フォント強制使用
+        title_run = self.centered_run("Game Result", None, 80, 80, theme.primary_color,
+                                      bold=True, italic=True, sprite=False)
+        title_run.region = 'header'
+        runs.append(title_run)
+        
+        # 「vs」をプレイヤー名の間に配置 - 斜体 ★英語フォント強制使用
+        # （幅は斜体で測定し、太字斜体で描画する）
+        player_y = 300  # layout_matchのプレイヤー名と同じ位置
+        vs_run = self.centered_run("vs", None, player_y + 50, 50, theme.accent_color,
+                                   italic=True, sprite=False)
+        vs_run.bold = True
+        vs_run.region = 'names'
+        runs.append(vs_run)
+        
+        # フッターテキスト ★英語フォント強制使用
+        runs.append(self.footer_run(theme))
+        
+        return runs, self.decoration_rects()
+    
+    def footer_run(self, theme=None):
+        """フッターテキストの配置"""
+        run = self.centered_run("Table Tennis Result Generator", None, self.height - 90, 30,
+                                (theme or self.theme).secondary_color, sprite=False)
+        run.region = 'footer'
+        return run
+    
+    def decoration_rects(self):
+        """装飾的な要素（塗りつぶし矩形、上の線・下の線の順）"""
+        return [
+            (100, 180, self.width - 100, 185),
+            (100, self.height - 150, self.width - 100, self.height - 145),
+        ]
+    
+    def scale_run(self, run, scale):
+        """TextRunの位置とフォントサイズを縮小（プレビュー用、scale=1ならそのまま）"""
+        if scale == 1:
+            return run
+        x, y = run.position
+        return TextRun(run.text, (round(x * scale), round(y * scale)), max(1, round(run.size * scale)),
+                       run.fill, bold=run.bold, italic=run.italic, japanese=run.japanese,
+                       sprite=run.sprite, region=run.region)
+    
+    def new_canvas(self, size, theme):
+        """テーマの背景（グラデーションが無ければ単色）のキャンバス"""
+        if theme.gradient is not None and effects_available():
+            start, end, angle = theme.gradient
+            return Image.fromarray(gradient_array(size[0], size[1], start, end, angle), 'RGB')
+        return Image.new('RGB', size, theme.bg_color)
+    
+    def draw_runs(self, img, draw, runs, theme, scale=1):
+        """
+        TextRunをまとめて描画（テーマに影・光彩があれば、先に文字の形から作って合成する）
+        スプライトの効果はスプライトと一緒にキャッシュし、名前など毎回変わる文字の分だけ計算する
+        """
+        if theme.text_effects and effects_available():
+            mask = None
+            for run in runs:
+                if run.sprite:
+                    x, y = run.position
+                    for color, layer, (offset_x, offset_y) in self.get_effect_sprite(run, theme, scale):
+                        img.paste(color, (x + offset_x, y + offset_y), layer)
+                    continue
+                if mask is None:
+                    mask = Image.new('L', img.size, 0)
+                    mask_draw = ImageDraw.Draw(mask)
+                self.draw_run_mask(mask, mask_draw, run)
+            if mask is not None:
+                apply_text_effects(img, mask, theme.text_effects, scale)
+        for run in runs:
+            self.draw_run(img, draw, run)
+    
+    def get_effect_sprite(self, run, theme, scale=1):
+        """
+        スプライトの影・光彩（run.positionからの相対位置付き、スプライトと同じキャッシュに登録）
+        効果は文字の形だけで決まるので、文字色（チームカラー）はキーに含めない
+        """
+        key = ('effect', run.text, self.get_variant(run.bold, run.italic), run.size,
+               tuple(effect.key() for effect in theme.text_effects), scale)
+        
+        def create():
+            sprite = self.get_sprite(run.text, run.size, run.fill, bold=run.bold, italic=run.italic)
+            # 効果が広がる分の余白を付けたマスクにスプライトの形を置く
+            pad = effect_margin(theme.text_effects, scale)
+            mask = Image.new('L', (sprite.image.width + 2 * pad, sprite.image.height + 2 * pad), 0)
+            mask.paste(sprite.image.getchannel('A'), (pad, pad))
+            return [(color, layer, (left - pad + sprite.offset[0], top - pad + sprite.offset[1]))
+                    for color, layer, (left, top) in effect_layers(mask, theme.text_effects, scale)]
+        
+        return self.sprite_cache.get_or_create(key, create)
+    
+    def render_static_layer(self, scale=1, theme=None):
+        """静的要素を描画した背景テンプレートを作成"""
+        theme = theme or self.theme
+        img = self.new_canvas((round(self.width * scale), round(self.height * scale)), theme)
+        draw = ImageDraw.Draw(img)
+        
+        runs, rects = self.layout_static(theme)
+        for rect in rects:
+            draw.rectangle([round(value * scale) for value in rect], fill=theme.primary_color)
+        self.draw_runs(img, draw, [self.scale_run(run, scale) for run in runs], theme, scale)
+        
+        return img
+    
+    def place_run(self, run, spec):
+        """TextRunを出力サイズの座標とフォントサイズに変換（1080×1080ならそのまま）"""
+        if spec.identity:
+            return run
+        return TextRun(run.text, spec.point(*run.position, run.region), max(1, round(run.size * spec.scale)),
+                       run.fill, bold=run.bold, italic=run.italic, japanese=run.japanese,
+                       sprite=run.sprite, region=run.region)
+    
+    def render_sized_layer(self, spec, theme=None):
+        """出力サイズ用の静的レイヤー（装飾の線は出力幅いっぱいに伸ばす）"""
+        theme = theme or self.theme
+        img = self.new_canvas((spec.width, spec.height), theme)
+        draw = ImageDraw.Draw(img)
+        
+        runs, rects = self.layout_static(theme)
+        margin = round(100 * spec.scale)
+        for (_, top, _, bottom), region in zip(rects, ('header', 'footer')):
+            _, y1 = spec.point(0, top, region)
+            _, y2 = spec.point(0, bottom, region)
+            draw.rectangle([margin, y1, spec.width - margin, y2], fill=theme.primary_color)
+        self.draw_runs(img, draw, [self.place_run(run, spec) for run in runs], theme, spec.scale)
+        
+        return img
+    
+    def get_background(self, scale=1, spec=None, theme=None):
+        """静的レイヤーのコピーを返す（テーマ・サイズ・縮尺ごとに一度だけ描画）"""
+        if spec is not None and spec.identity:
+            spec = None
+        key = self.get_background_key(theme) + ((scale,) if spec is None else (spec.width, spec.height))
+        
+        def create():
+            if spec is None:
+                return self.render_static_layer(scale, theme)
+            return self.render_sized_layer(spec, theme)
+        
+        template = self.background_cache.get_or_create(key, create)
+        return self.canvas_pool.acquire(template)
+    
+    def release_canvas(self, img):
+        """描画済みの画像が不要になったらプールに戻す（以後その画像を使わないこと）"""
+        self.canvas_pool.release(img)
+    
+    def measure_advance(self, text, size, bold=False, italic=False, japanese=False):
+        """テキストの送り幅（次の区間の描画開始位置までの距離、メモ化）"""
+        key = ('advance', text, 'japanese' if japanese else 'english', self.get_variant(bold, italic), size)
+        advance = self.measure_cache.lookup(key)
+        if advance is None:
+            font = self.get_font(size, bold=bold, italic=italic, japanese=japanese)
+            if font is None:
+                raise ValueError(f"No font available to measure: {text}")
+            advance = round(font.getlength(text))
+            self.measure_cache.store(key, advance)
+        return advance
+    
+    def text_runs(self, text, x, y, size, fill, bold=False, italic=False, center=False):
+        """
+        テキストをフォント別の区間ごとのTextRunにして並べる（プレイヤー名用）
+        centerがTrueならxを中心に配置する。区間が1つなら従来と同じ1つのTextRunになる
+        """
+        segments = self.segment_text(text, bold=bold, italic=italic) or (('', False),)
+        if len(segments) == 1:
+            japanese = segments[0][1]
+            if center:
+                return [self.centered_run(text, x, y, size, fill, bold=bold, italic=italic,
+                                          japanese=japanese, sprite=False)]
+            return [TextRun(text, (x, y), size, fill, bold=bold, italic=italic, japanese=japanese)]
+        
+        # 区間ごとに送り幅を測り、ベースラインを最初の区間のフォントに揃える
+        advances = [self.measure_advance(part, size, bold=bold, italic=italic, japanese=japanese)
+                    for part, japanese in segments]
+        if center:
+            x = x - self.text_width(text, size, bold=bold, italic=italic) // 2
+        
+        ascents = [self.get_font(size, bold=bold, italic=italic, japanese=japanese).getmetrics()[0]
+                   for _, japanese in segments]
+        baseline = y + ascents[0]
+        runs = []
+        for (part, japanese), advance, ascent in zip(segments, advances, ascents):
+            runs.append(TextRun(part, (x, baseline - ascent), size, fill, bold=bold, italic=italic,
+                                japanese=japanese))
+            x += advance
+        return runs
+    
+    def text_width(self, text, size, bold=False, italic=False):
+        """フォント別の区間に分けたテキスト全体の幅（区間ごとの測定結果はキャッシュ済み）"""
+        segments = self.segment_text(text, bold=bold, italic=italic)
+        if not segments:
+            return 0
+        width = sum(self.measure_advance(part, size, bold=bold, italic=italic, japanese=japanese)
+                    for part, japanese in segments[:-1])
+        last_part, last_japanese = segments[-1]
+        return width + self.measure_text(last_part, size, bold=bold, italic=italic,
+                                         japanese=last_japanese)
+    
+    def fit_text(self, text, max_width, max_size, min_size, bold=False, italic=False):
+        """
+        max_widthに収まる最大のフォントサイズを選ぶ（最小サイズでも収まらなければ末尾を省略）
+        Returns:
+            (描画するテキスト, フォントサイズ)
+        """
+        key = (text, self.get_variant(bold, italic), max_width, max_size, min_size)
+        return self.fit_cache.get_or_create(
+            key, lambda: self.compute_fit(text, max_width, max_size, min_size, bold, italic))
+    
+    def compute_fit(self, text, max_width, max_size, min_size, bold=False, italic=False):
+        """fit_textの計算（サイズと省略位置をそれぞれ二分探索する）"""
+        def fits(candidate, size):
+            return self.text_width(candidate, size, bold=bold, italic=italic) <= max_width
+        
+        try:
+            # 大きい順のサイズ候補。ほとんどの名前は最大サイズで収まるので先に確認する
+            sizes = list(range(max_size, min_size - 1, -NAME_SIZE_STEP))
+            if sizes[-1] != min_size:
+                sizes.append(min_size)
+            if fits(text, max_size):
+                return text, max_size
+            
+            # sizes[low]は収まらない、sizes[high]は収まる（high == len(sizes) は最小でも収まらない）
+            low, high = 0, len(sizes)
+            while high - low > 1:
+                middle = (low + high) // 2
+                if fits(text, sizes[middle]):
+                    high = middle
+                else:
+                    low = middle
+            if high < len(sizes):
+                return text, sizes[high]
+            
+            # 最小サイズで「…」を付けて収まる最長の先頭部分を探す
+            low, high = 0, len(text)
+            while low < high:
+                middle = (low + high + 1) // 2
+                if fits(text[:middle].rstrip() + ELLIPSIS, min_size):
+                    low = middle
+                else:
+                    high = middle - 1
+            return text[:low].rstrip() + ELLIPSIS, min_size
+        except Exception as e:
+            print(f"Text fitting failed: {e}")
+            return text, max_size
+    
+    def measure_text(self, text, size, bold=False, italic=False, japanese=False):
+        """テキスト幅を測定（(テキスト, フォント, サイズ) ごとにメモ化）"""
+        start = time.perf_counter()
+        key = (text, 'japanese' if japanese else 'english', self.get_variant(bold, italic), size)
+        width = self.measure_cache.lookup(key)
+        if width is None:
+            font = self.get_font(size, bold=bold, italic=italic, japanese=japanese)
+            if font is None:
+                raise ValueError(f"No font available to measure: {text}")
+            left, _, right, _ = font.getbbox(text)
+            width = right - left
+            self.measure_cache.store(key, width)
+        metrics.add('measure', time.perf_counter() - start)
+        return width
+    
+    def centered_run(self, text, center_x, y, size, fill, bold=False, italic=False,
+                     japanese=False, sprite=True):
+        """center_xを中心に配置したTextRunを作成（center_xがNoneなら画像中央）"""
+        try:
+            width = self.measure_text(text, size, bold=bold, italic=italic, japanese=japanese)
+        except Exception:
+            width = len(text) * size // 2  # フォールバック計算
+        
+        if center_x is None:
+            x = (self.width - width) // 2
+        else:
+            x = center_x - width // 2
+        return TextRun(text, (x, y), size, fill, bold=bold, italic=italic,
+                       japanese=japanese, sprite=sprite)
+    
+    def layout_match(self, player1, player2, scores, match_type, theme=None):
+        """試合データから描画するテキストと位置を決める（ラスタライズは行わない）"""
+        theme = theme or self.theme
+        # 勝者を判定
+        player1_wins = sum(1 for score in scores if score[0] > score[1])
+        player2_wins = sum(1 for score in scores if score[1] > score[0])
+        winner = player1 if player1_wins > player2_wins else player2
+        
+        # プレイヤー名と各セットのスコアを左右に配置
+        left_x = 230
+        right_x = self.width - 230
+        score_left_x = 420
+        score_right_x = self.width - 420
+        runs = []
+        
+        # WIN表示 - 斜体 ★英語フォント強制使用（スプライト貼り付け）
+        win_x = left_x if winner == player1 else right_x
+        win_run = self.centered_run("WIN", win_x, 230, 60, theme.accent_color,
+                                    bold=True, italic=True)
+        runs.append(win_run)
+        
+        # プレイヤー名を配置 - タイトルと同じサイズ（80） ★プレイヤー名のみ自動判定フォント使用
+        # （英語と日本語が混在する名前は文字ごとに描けるフォントを選んで区間に分ける）
+        # 列幅に収まらない長い名前は縮小し、それでも収まらなければ末尾を省略する
+        player_y = 300
+        name_runs = []
+        # 名前と最終スコアはチームカラーがあればその色で描く
+        for index, (name, center_x) in enumerate(((player1, left_x), (player2, right_x))):
+            fitted, size = self.fit_text(name, NAME_MAX_WIDTH, 80, NAME_MIN_SIZE, bold=True)
+            name_runs.extend(self.text_runs(fitted, center_x, player_y + (80 - size) // 2, size,
+                                            theme.player_color(index, theme.secondary_color),
+                                            bold=True, center=True))
+        runs.extend(name_runs)
+        steps = [name_runs]
+        
+        # 各セットのスコアの配置計算
+        num_sets = len(scores)
+        line_height = 50
+        final_y = 540
+        
+        if num_sets == 1:
+            center_set_index = 0
+        elif num_sets <= 3:
+            center_set_index = 1
+        elif num_sets <= 5:
+            center_set_index = 2
+        else:
+            center_set_index = 3
+        
+        score_start_y = final_y + 50 - (center_set_index * line_height)
+        
+        # 各セットのスコア表示 - 斜体 ★英語フォント強制使用（スプライト貼り付け）
+        for i, (score1, score2) in enumerate(scores):
+            y_pos = score_start_y + i * line_height
+            set_runs = [
+                self.centered_run(str(score1), score_left_x, y_pos, 35,
+                                  theme.secondary_color, italic=True),
+                self.centered_run(str(score2), score_right_x, y_pos, 35,
+                                  theme.secondary_color, italic=True),
+                # 中央のハイフン
+                self.centered_run("-", None, y_pos, 35, theme.secondary_color, italic=True),
+            ]
+            runs.extend(set_runs)
+            steps.append(set_runs)
+        
+        # 最終スコア（セット数）- 斜体 ★英語フォント強制使用（スプライト貼り付け）
+        final_runs = [
+            self.centered_run(str(player1_wins), left_x, final_y, 120,
+                              theme.player_color(0, theme.primary_color), bold=True, italic=True),
+            self.centered_run(str(player2_wins), right_x, final_y, 120,
+                              theme.player_color(1, theme.primary_color), bold=True, italic=True),
+        ]
+        runs.extend(final_runs)
+        steps.append(final_runs + [win_run])
+        
+        # 縦長の出力サイズでは名前（勝者表示を含む）の帯とスコアの帯を離して配置する（CanvasSpec）
+        for run in [win_run] + name_runs:
+            run.region = 'names'
+        for run in runs:
+            if run.region == 'body':
+                run.region = 'scores'
+        
+        return MatchLayout(self.width, self.height, runs, player1_wins, player2_wins, winner, steps,
+                           theme)
+    
+    def draw_run(self, img, draw, run):
+        """TextRunを1つ描画（スコア・固定ラベルはスプライト、名前は通常のテキスト描画）"""
+        try:
+            if run.sprite:
+                sprite = self.get_sprite(run.text, run.size, run.fill, bold=run.bold, italic=run.italic)
+                x, y = run.position
+                img.paste(sprite.image, (x + sprite.offset[0], y + sprite.offset[1]), sprite.image)
+                return
+            
+            font = self.get_font(run.size, bold=run.bold, italic=run.italic, japanese=run.japanese)
+            if font:
+                draw.text(run.position, run.text, fill=run.fill, font=font)
+            else:
+                # フォント取得に失敗した場合
+                draw.text(run.position, run.text, fill=run.fill)
+        except Exception as e:
+            print(f"Text drawing failed: {e}")
+            try:
+                # 最終フォールバック
+                draw.text(run.position, run.text, fill=run.fill)
+            except Exception as e2:
+                print(f"Final fallback also failed: {e2}")
+    
+    def draw_run_mask(self, mask, draw, run):
+        """TextRunの文字の形だけをマスク（Lモード）に描く（影・光彩の元）"""
+        try:
+            if run.sprite:
+                sprite = self.get_sprite(run.text, run.size, run.fill, bold=run.bold, italic=run.italic)
+                x, y = run.position
+                alpha = sprite.image.getchannel('A')
+                mask.paste(255, (x + sprite.offset[0], y + sprite.offset[1]), alpha)
+                return
+            font = self.get_font(run.size, bold=run.bold, italic=run.italic, japanese=run.japanese)
+            draw.text(run.position, run.text, fill=255, font=font)
+        except Exception as e:
+            print(f"Text effect mask failed: {e}")
+    
+    def render_layout(self, layout, scale=1):
+        """レイアウトに従って描画のみを行う（scaleを指定すると縮小したフォントで直接描画）"""
+        # 背景テンプレートのコピーからDrawオブジェクトを作成
+        theme = layout.theme or self.theme
+        img = self.get_background(scale, theme=theme)
+        draw = ImageDraw.Draw(img)
+        self.draw_runs(img, draw, [self.scale_run(run, scale) for run in layout.runs], theme, scale)
+        return img
+    
+    def rasterize(self, layout, spec):
+        """デザイン座標のレイアウトを出力サイズで描画（フォントは出力サイズで直接ラスタライズ）"""
+        if spec.identity:
+            return self.render_layout(layout)
+        theme = layout.theme or self.theme
+        img = self.get_background(spec=spec, theme=theme)
+        draw = ImageDraw.Draw(img)
+        self.draw_runs(img, draw, [self.place_run(run, spec) for run in layout.runs], theme, spec.scale)
+        return img
+    
+    def create_image(self, player1, player2, scores, match_type, theme=None):
+        layout = self.layout_match(player1, player2, scores, match_type, theme)
+        return self.render_layout(layout)
+    
+    def create_animation(self, player1, player2, scores, match_type, theme=None):
+        """
+        セットごとにスコアを表示していくアニメーションのフレームを作成
+        各フレームは前のフレームに新しく表示する要素だけを描き足して作る（毎回全体を描画しない）
+        Returns:
+            (フレームのリスト, 各フレームの表示時間ms)
+        """
+        layout = self.layout_match(player1, player2, scores, match_type, theme)
+        canvas = self.get_background(theme=layout.theme)
+        draw = ImageDraw.Draw(canvas)
+        frames = []
+        for step_runs in layout.steps:
+            self.draw_runs(canvas, draw, step_runs, layout.theme)
+            frames.append(canvas.copy())
+        self.release_canvas(canvas)
+        
+        durations = [ANIMATION_FRAME_MS] * (len(frames) - 1) + [ANIMATION_HOLD_MS]
+        return frames, durations
+    
+    def create_preview(self, player1, player2, scores, match_type, width, theme=None):
+        """プレビュー用の低解像度画像（縮小ではなく小さいフォントで直接描画）"""
+        layout = self.layout_match(player1, player2, scores, match_type, theme)
+        return self.render_layout(layout, scale=width / self.width)
+    
+    def layout_standings(self, title, standings):
+        """順位表のレイアウト（試合結果と同じ配色・フォント）"""
+        runs = [self.centered_run(title, None, 80, 80, self.primary_color,
+                                  bold=True, italic=True, sprite=False)]
+        
+        # 列の中心X座標（選手名のみ左揃え）
+        name_x = 190
+        name_width = 320  # 「P」列と重ならない幅
+        # セット・得点は順位の判定に使う得失差で表示
+        columns = (('#', 130), ('P', 560), ('W', 650), ('L', 740), ('Sets', 840), ('Pts', 950))
+        header_y = 220
+        row_y = 280
+        line_height = 55
+        
+        runs.append(TextRun("Player", (name_x, header_y), 30, self.accent_color, bold=True))
+        for label, center_x in columns:
+            runs.append(self.centered_run(label, center_x, header_y, 30, self.accent_color,
+                                          bold=True, sprite=False))
+        
+        for i, standing in enumerate(standings):
+            y_pos = row_y + i * line_height
+            name = standing['player']
+            values = (str(standing['rank']), str(standing['played']), str(standing['wins']),
+                      str(standing['losses']),
+                      f"{standing['sets_won'] - standing['sets_lost']:+d}",
+                      f"{standing['points_won'] - standing['points_lost']:+d}")
+            fitted, size = self.fit_text(name, name_width, 35, 23, bold=True)
+            runs.extend(self.text_runs(fitted, name_x, y_pos + (35 - size) // 2, size,
+                                       self.secondary_color, bold=True))
+            for value, (_, center_x) in zip(values, columns):
+                runs.append(self.centered_run(value, center_x, y_pos, 35, self.secondary_color,
+                                              italic=True, sprite=False))
+        return runs
+    
+    def create_standings_image(self, title, standings):
+        """順位表の画像を作成（standingsはStandingsStore.standings()の結果）"""
+        img = Image.new('RGB', (self.width, self.height), self.bg_color)
+        draw = ImageDraw.Draw(img)
+        
+        # 装飾的な要素とフッターは試合結果と共通
+        for rect in self.decoration_rects():
+            draw.rectangle(list(rect), fill=self.primary_color)
+        
+        for run in self.layout_standings(title, standings) + [self.footer_run()]:
+            self.draw_run(img, draw, run)
+        return img
+    
+    def svg_run(self, run, defs):
+        """TextRunをSVG要素に変換（使用したグリフはdefsに追加）"""
+        x, y = run.position
+        fill = svg_color(run.fill)
+        font_path = self.get_font_path(bold=run.bold, italic=run.italic, japanese=run.japanese)
+        font = self.get_font(run.size, bold=run.bold, italic=run.italic, japanese=run.japanese)
+        
+        # アウトラインが取れない場合（fontTools無し・デフォルトフォント）はtext要素で出力
+        if TTFont is None or not isinstance(font_path, str) or font is None:
+            weight = 'bold' if run.bold else 'normal'
+            style = 'italic' if run.italic else 'normal'
+            return (f'<text x="{x}" y="{y + run.size}" font-family="sans-serif" '
+                    f'font-size="{run.size}" font-weight="{weight}" font-style="{style}" '
+                    f'fill="{fill}">{escape(run.text)}</text>')
+        
+        # PILと同じくyはアセンダーの上端なので、ベースライン位置に変換する
+        baseline = y + font.getmetrics()[0]
+        font_id = self.svg_font_ids.setdefault(font_path, len(self.svg_font_ids))
+        
+        uses = []
+        pen_x = 0
+        scale = None
+        for char in run.text:
+            outline = get_glyph_outline(font_path, char)
+            scale = run.size / outline.units_per_em
+            if outline.path:
+                glyph_ref = f'g{font_id}-{outline.glyph_id}'
+                if glyph_ref not in defs:
+                    defs[glyph_ref] = f'<path id="{glyph_ref}" d="{outline.path}"/>'
+                uses.append(f'<use xlink:href="#{glyph_ref}" x="{pen_x}"/>')
+            pen_x += outline.advance
+        
+        if not uses:
+            return ''
+        return (f'<g transform="translate({x},{baseline}) scale({scale:.6f},{-scale:.6f})" '
+                f'fill="{fill}">{"".join(uses)}</g>')
+    
+    def render_svg(self, layout):
+        """レイアウトをSVGとして出力（使用したグリフのアウトラインのみ埋め込む）"""
+        theme = layout.theme or self.theme
+        static_runs, rects = self.layout_static(theme)
+        defs = {}
+        background = svg_color(theme.bg_color)
+        if theme.gradient is not None:
+            # グラデーションはSVGのlinearGradientで表す（文字の影・光彩はSVGには出力しない）
+            start, end, angle = theme.gradient
+            radians = math.radians(angle)
+            defs['background'] = (
+                f'<linearGradient id="background" gradientUnits="userSpaceOnUse" x1="0" y1="0" '
+                f'x2="{round(math.cos(radians) * self.width)}" y2="{round(math.sin(radians) * self.height)}">'
+                f'<stop offset="0" stop-color="{svg_color(start)}"/>'
+                f'<stop offset="1" stop-color="{svg_color(end)}"/></linearGradient>')
+            background = 'url(#background)'
+        body = [f'<rect width="{self.width}" height="{self.height}" fill="{background}"/>']
+        
+        for left, top, right, bottom in rects:
+            # PILの矩形は両端を含むため幅・高さに1を足す
+            body.append(f'<rect x="{left}" y="{top}" width="{right - left + 1}" '
+                        f'height="{bottom - top + 1}" fill="{svg_color(theme.primary_color)}"/>')
+        for run in static_runs + layout.runs:
+            body.append(self.svg_run(run, defs))
+        
+        return ''.join([
+            f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+            f'width="{layout.width}" height="{layout.height}" viewBox="0 0 {layout.width} {layout.height}">',
+            '<defs>', *defs.values(), '</defs>',
+            *body,
+            '</svg>',
+        ])
+    
+    def warm_up(self):
+        """フォント・背景・スプライトのキャッシュを事前に温める"""
+        self.create_image("Player", "プレイヤー", [(11, 9), (9, 11), (11, 7), (7, 11), (11, 5), (5, 11), (12, 10)],
+                          "7セットマッチ")
+        # テーマごとの背景（グラデーション・固定テキストの効果）
+        for theme in THEMES.values():
+            self.release_canvas(self.get_background(theme=theme))
+        # よく使うスコア数字とセット数
+        for score in range(31):
+            self.get_sprite(str(score), 35, self.secondary_color, italic=True)
+        for sets in range(5):
+            self.get_sprite(str(sets), 120, self.primary_color, bold=True, italic=True)
+
+class EmergencyGenerator:
+    """フォント設定に失敗した場合の最低限の生成器（完全なフォールバック、テーマは使わない）"""
+    def create_image(self, player1, player2, scores, match_type, theme=None):
+        img = Image.new('RGB', (1080, 1080), (255, 255, 255))
+        draw = ImageDraw.Draw(img)
+        
+        # 基本的なテキスト描画（フォント無し）
+        draw.text((540, 200), "Game Result", fill=(0, 0, 0), anchor="mm")
+        draw.text((270, 400), player1, fill=(0, 0, 0), anchor="mm")
+        draw.text((810, 400), player2, fill=(0, 0, 0), anchor="mm")
+        draw.text((540, 400), "vs", fill=(255, 0, 0), anchor="mm")
+        
+        player1_wins = sum(1 for score in scores if score[0] > score[1])
+        player2_wins = sum(1 for score in scores if score[1] > score[0])
+        
+        draw.text((270, 600), str(player1_wins), fill=(0, 0, 0), anchor="mm")
+        draw.text((810, 600), str(player2_wins), fill=(0, 0, 0), anchor="mm")
+        
+        return img
+
+def create_generator():
+    """生成器を作成（エラーハンドリング付き、ここでフォントを検出する）"""
+    try:
+        generator = TableTennisImageGenerator()
+        print("Table Tennis Image Generator initialized successfully")
+        return generator
+    except Exception as e:
+        print(f"Critical Error: Generator initialization failed: {e}")
+        return EmergencyGenerator()
+
+class MatchInputError(ValueError):
+    """入力内容の不備（400として返す）"""
+    pass
+
+# 必須項目と、無い場合のエラーメッセージでの名前
+REQUIRED_FIELDS = {'player1': 'プレイヤー1', 'player2': 'プレイヤー2', 'match_type': 'マッチタイプ'}
+
+def form_text(form, key):
+    """
+    フォームの値を文字列で取り出す（無い・None・空は''）
+    JSONの数値やnull、CSVの短い行（DictReaderが足りない列をNoneにする）にも対応する
+    """
+    value = form.get(key)
+    return '' if value is None else str(value)
+
+def parse_match_form(form):
+    """フォーム（またはバッチの1行）から試合データを取り出す"""
+    for key, label in REQUIRED_FIELDS.items():
+        if form.get(key) is None:
+            raise MatchInputError(f"{label}（{key}）が入力されていません。")
+    player1 = form_text(form, 'player1')
+    player2 = form_text(form, 'player2')
+    match_type = form_text(form, 'match_type')
+    
+    for name in (player1, player2):
+        if len(name) > MAX_NAME_LENGTH:
+            raise MatchInputError(f"プレイヤー名は{MAX_NAME_LENGTH}文字以内で入力してください。")
+    
+    # スコアを取得
+    scores = []
+    try:
+        max_sets = int(str(match_type).replace('セットマッチ', ''))
+    except ValueError:
+        max_sets = None
+    if max_sets not in MATCH_SET_COUNTS:
+        raise MatchInputError(f"マッチタイプが不正です: {match_type}")
+    
+    for i in range(max_sets):
+        score1_key = f'set{i+1}_score1'
+        score2_key = f'set{i+1}_score2'
+        
+        # JSONの数値にも対応するため文字列として扱う（0も有効なスコア、null・空欄は未入力）
+        score1 = form_text(form, score1_key)
+        score2 = form_text(form, score2_key)
+        
+        if score1 and score2:
+            try:
+                score = (int(score1), int(score2))
+            except ValueError:
+                raise MatchInputError(f"第{i+1}セットのスコアが不正です。")
+            if not all(0 <= value <= MAX_SCORE for value in score):
+                raise MatchInputError(f"スコアは0〜{MAX_SCORE}の範囲で入力してください。")
+            scores.append(score)
+    
+    if not scores:
+        raise MatchInputError("少なくとも1セットのスコアを入力してください。")
+    
+    return player1, player2, scores, match_type
+
+def parse_output_options(form):
+    """出力形式（format）と圧縮レベル（level）を取り出す"""
+    output_format = str(form.get('format') or 'png').lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise MatchInputError(f"未対応の出力形式です: {output_format}")
+    
+    level = form.get('level')
+    if level is None or str(level) == '' or output_format not in LEVEL_RANGES:
+        return output_format, None
+    try:
+        value = int(level)
+    except ValueError:
+        raise MatchInputError(f"圧縮レベルが不正です: {level}")
+    low, high = LEVEL_RANGES[output_format]
+    if not low <= value <= high:
+        raise MatchInputError(f"{output_format}の圧縮レベルは{low}〜{high}で指定してください: {level}")
+    return output_format, value
+
+def parse_animation_option(form, output_format):
+    """アニメーション出力（animated=1）の指定を取り出す"""
+    animated = str(form.get('animated') or '').lower() in ('1', 'true', 'on', 'yes')
+    if animated and output_format not in ANIMATED_FORMATS:
+        raise MatchInputError(f"この出力形式はアニメーションに対応していません: {output_format}")
+    return animated
+
+def parse_theme_option(form):
+    """テーマ（theme）とチームカラー（team1_color / team2_color、#rrggbb）を取り出す（省略時はNone）"""
+    name = str(form.get('theme') or '').strip().lower()
+    colors = []
+    for key in ('team1_color', 'team2_color'):
+        value = form.get(key)
+        try:
+            colors.append(parse_color(value) if value else None)
+        except ValueError:
+            raise MatchInputError(f"チームカラーは#rrggbb形式で指定してください: {value}")
+    
+    if not name and not any(colors):
+        return None
+    if name and name not in THEMES:
+        raise MatchInputError(f"未対応のテーマです: {name}")
+    theme = THEMES[name] if name else THEMES.get(DEFAULT_THEME, THEMES['classic'])
+    return theme.with_player_colors(*colors)
+
+def encode_match(generator, player1, player2, scores, match_type, output_format='png', level=None,
+                 animated=False, theme=None):
+    """試合結果を描画し、指定形式でエンコードしたバイト列にする"""
+    start = time.perf_counter()
+    if animated:
+        frames, durations = generator.create_animation(player1, player2, scores, match_type, theme)
+        rendered = time.perf_counter()
+        image_bytes = encode_animation(frames, durations, output_format, level)
+        metrics.add('render', rendered - start)
+        metrics.add('encode', time.perf_counter() - rendered)
+        return image_bytes
+    
+    if output_format == 'svg':
+        # SVGはラスタライズ・エンコードを行わず文字列を組み立てるだけ
+        layout = generator.layout_match(player1, player2, scores, match_type, theme)
+        image_bytes = generator.render_svg(layout).encode('utf-8')
+        metrics.add('render', time.perf_counter() - start)
+        return image_bytes
+    
+    img = generator.create_image(player1, player2, scores, match_type, theme)
+    rendered = time.perf_counter()
+    canvas_bytes = image_nbytes(img)
+    metrics.allocate(canvas_bytes)
+    image_bytes = encode_image(img, output_format, level)
+    metrics.allocate(len(image_bytes))
+    metrics.add('render', rendered - start)
+    metrics.add('encode', time.perf_counter() - rendered)
+    
+    if hasattr(generator, 'release_canvas'):
+        generator.release_canvas(img)
+    metrics.free(canvas_bytes)
+    return image_bytes
+
+def parse_size_options(form):
+    """出力サイズ（sizes=square,story,landscape、複数指定可）を取り出す（省略時は全サイズ）"""
+    values = form.getlist('sizes') if hasattr(form, 'getlist') else [form.get('sizes') or '']
+    names = [name.strip().lower() for value in values for name in str(value).split(',') if name.strip()]
+    if not names:
+        return list(OUTPUT_SIZES)
+    for name in names:
+        if name not in OUTPUT_SIZES:
+            raise MatchInputError(f"未対応の出力サイズです: {name}")
+    return list(dict.fromkeys(names))
+
+# 複数サイズを並列にラスタライズ・エンコードするスレッド数
+SIZE_WORKERS = int(os.environ.get('SIZE_WORKERS', len(OUTPUT_SIZES)))
+size_executor = None
+size_executor_lock = threading.Lock()
+
+def get_size_executor():
+    """サイズ別描画用のスレッドプール（fork後のワーカーで初めて使うときに作成）"""
+    global size_executor
+    with size_executor_lock:
+        if size_executor is None:
+            size_executor = ThreadPoolExecutor(max_workers=SIZE_WORKERS,
+                                               thread_name_prefix='size-render')
+        return size_executor
+
+def encode_match_sizes(generator, player1, player2, scores, match_type, sizes,
+                       output_format='png', level=None, theme=None):
+    """
+    1つのレイアウトから複数の出力サイズを描画・エンコードする
+    入力の解析・勝者判定・名前のフォント分割と測定は一度だけ行い、サイズごとの描画は並列に行う
+    Returns:
+        {サイズ名: バイト列}（sizesの順）
+    """
+    if output_format == 'svg':
+        raise MatchInputError("複数サイズの出力はラスター形式のみ対応しています。")
+    
+    start = time.perf_counter()
+    if hasattr(generator, 'layout_match'):
+        layout = generator.layout_match(player1, player2, scores, match_type, theme)
+        metrics.add('layout', time.perf_counter() - start)
+        
+        def render_size(name):
+            img = generator.rasterize(layout, CanvasSpec(name, *OUTPUT_SIZES[name]))
+            image_bytes = encode_image(img, output_format, level)
+            generator.release_canvas(img)
+            return image_bytes
+    else:
+        # 最低限の生成器は正方形のみ描けるので、余白を付けて各サイズにする
+        square = generator.create_image(player1, player2, scores, match_type)
+        
+        def render_size(name):
+            return encode_image(ImageOps.pad(square, OUTPUT_SIZES[name], color=(255, 255, 255)),
+                                output_format, level)
+    
+    # スレッドプールのワーカーではリクエスト単位の計測は行われないので、全体の時間を記録する
+    rendered = time.perf_counter()
+    results = dict(zip(sizes, get_size_executor().map(render_size, sizes)))
+    metrics.add('render_sizes', time.perf_counter() - rendered)
+    metrics.allocate(sum(len(image_bytes) for image_bytes in results.values()))
+    return results
+
+def match_filename(player1, player2, extension, index=None, size=None):
+    """出力ファイル名（パス区切り文字は置き換える）"""
+    safe_name = f'{player1}_vs_{player2}'.replace('/', '_').replace('\\', '_')
+    prefix = f'{index + 1:04d}_' if index is not None else ''
+    suffix = f'_{size}' if size is not None else ''
+    return f'{prefix}GameResult_{safe_name}{suffix}.{extension}'
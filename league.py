@@ -0,0 +1,125 @@
+"""
+リーグ戦の試合結果ストアと順位表
+
+試合を登録するたびに、その試合の2人分の集計行だけを更新する（全試合の再集計はしない）。
+gunicornの複数ワーカーから同じデータを参照できるようにSQLiteに保存する。
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    season TEXT NOT NULL,
+    match_id TEXT,
+    player1 TEXT NOT NULL,
+    player2 TEXT NOT NULL,
+    scores TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    UNIQUE (season, match_id)
+);
+CREATE TABLE IF NOT EXISTS standings (
+    season TEXT NOT NULL,
+    player TEXT NOT NULL,
+    played INTEGER NOT NULL DEFAULT 0,
+    wins INTEGER NOT NULL DEFAULT 0,
+    losses INTEGER NOT NULL DEFAULT 0,
+    sets_won INTEGER NOT NULL DEFAULT 0,
+    sets_lost INTEGER NOT NULL DEFAULT 0,
+    points_won INTEGER NOT NULL DEFAULT 0,
+    points_lost INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (season, player)
+);
+"""
+
+# 1人分の集計を加算するUPSERT
+UPSERT_STANDING = """
+INSERT INTO standings (season, player, played, wins, losses, sets_won, sets_lost, points_won, points_lost)
+VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (season, player) DO UPDATE SET
+    played = played + 1,
+    wins = wins + excluded.wins,
+    losses = losses + excluded.losses,
+    sets_won = sets_won + excluded.sets_won,
+    sets_lost = sets_lost + excluded.sets_lost,
+    points_won = points_won + excluded.points_won,
+    points_lost = points_lost + excluded.points_lost
+"""
+
+# 順位: 勝利数 → セット得失差 → 得失点差 → 名前
+RANKING_ORDER = """
+ORDER BY wins DESC, (sets_won - sets_lost) DESC, (points_won - points_lost) DESC, player
+"""
+
+STANDING_COLUMNS = ('player', 'played', 'wins', 'losses', 'sets_won', 'sets_lost',
+                    'points_won', 'points_lost')
+
+def summarize_match(scores):
+    """スコアから (セット数1, セット数2, 得点1, 得点2) を計算"""
+    sets1 = sum(1 for score1, score2 in scores if score1 > score2)
+    sets2 = sum(1 for score1, score2 in scores if score2 > score1)
+    points1 = sum(score1 for score1, _ in scores)
+    points2 = sum(score2 for _, score2 in scores)
+    return sets1, sets2, points1, points2
+
+class StandingsStore:
+    """シーズンごとの試合結果と順位表（SQLite）"""
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def connect(self):
+        """スレッドごとの接続を返す（sqlite3の接続はスレッド間で共有できない）"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or getattr(self.local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def add_matches(self, season, matches):
+        """
+        試合をまとめて登録し、関係する選手の集計だけを更新する
+        Args:
+            matches: (player1, player2, scores, match_id) のリスト（match_idはNone可）
+        Returns:
+            新たに登録した試合数（同じmatch_idの再送は無視）
+        """
+        added = 0
+        conn = self.connect()
+        with conn:  # 1トランザクション
+            for player1, player2, scores, match_id in matches:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO matches (season, match_id, player1, player2, scores, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (season, match_id, player1, player2, json.dumps(scores), time.time()))
+                if cursor.rowcount == 0:
+                    continue  # 登録済み
+
+                sets1, sets2, points1, points2 = summarize_match(scores)
+                conn.execute(UPSERT_STANDING, (season, player1, int(sets1 > sets2), int(sets2 > sets1),
+                                               sets1, sets2, points1, points2))
+                conn.execute(UPSERT_STANDING, (season, player2, int(sets2 > sets1), int(sets1 > sets2),
+                                               sets2, sets1, points2, points1))
+                added += 1
+        return added
+
+    def standings(self, season, limit=None):
+        """順位表（順位順の辞書のリスト）"""
+        query = f"SELECT {', '.join(STANDING_COLUMNS)} FROM standings WHERE season = ? {RANKING_ORDER}"
+        params = [season]
+        if limit:
+            query += " LIMIT ?"
+            params.append(int(limit))
+        rows = self.connect().execute(query, params).fetchall()
+        return [dict(zip(STANDING_COLUMNS, row), rank=rank) for rank, row in enumerate(rows, 1)]
+
+    def match_count(self, season):
+        return self.connect().execute(
+            "SELECT COUNT(*) FROM matches WHERE season = ?", (season,)).fetchone()[0]
@@ -0,0 +1,133 @@
+"""
+1リクエスト分のプロファイル（呼び出しスタックごとの所要時間）
+
+sys.setprofile で対象のスレッドの関数呼び出し（C関数を含む）をすべて記録し、
+スタックごとの自己時間を集計して、フレームグラフのツール（flamegraph.pl・speedscope・inferno）が
+読める折りたたみ形式（"関数;関数;関数 マイクロ秒" の行）で保存する。
+1回の描画は数ms〜数十msで、サンプリングでは数サンプルしか取れないため、全呼び出しを記録する。
+
+create_image・get_font・img.save（PIL.Image.save）の呼び出しは、その上に [create_image] のような
+段階名のフレームを挟んで見分けられるようにする。
+記録中のスレッドだけが遅くなり（数倍）、記録される時間もその分長くなる（実際の所要時間ではなく、
+段階・関数の間の比較に使う）。プロファイルを取らないときは何も設定しない。
+"""
+import os
+import sys
+import threading
+import time
+
+# 段階名を付ける関数（ファイル名, 関数名） -> 段階名
+STAGE_FUNCTIONS = {
+    ('image_generator.py', 'create_image'): 'create_image',
+    ('image_generator.py', 'get_font'): 'get_font',
+    ('Image.py', 'save'): 'img.save',
+}
+
+def frame_label(code):
+    """Pythonの関数のフレーム名（ファイル名:関数名）"""
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+def c_function_label(function):
+    """C関数のフレーム名（モジュール名.関数名）"""
+    module = getattr(function, '__module__', None) or type(getattr(function, '__self__', None)).__name__
+    return f"{module}.{getattr(function, '__qualname__', function.__name__)}"
+
+class StackProfiler:
+    """sys.setprofileで現在のスレッドの呼び出しを記録し、スタックごとの自己時間を集計する"""
+    def __init__(self):
+        self.times = {}  # スタック（フレーム名のタプル）-> 秒
+        self.stack = []
+        self.pushed = []  # 呼び出しごとに積んだフレーム数（段階名を挟んだら2）
+        self.last = None
+        self.thread_id = None
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.last = time.perf_counter()
+        sys.setprofile(self.callback)
+
+    def stop(self):
+        sys.setprofile(None)
+        self.account(time.perf_counter())
+
+    def account(self, now):
+        """直前のイベントからの時間を現在のスタックの自己時間として計上"""
+        if self.stack:
+            key = tuple(self.stack)
+            self.times[key] = self.times.get(key, 0.0) + (now - self.last)
+
+    def callback(self, frame, event, arg):
+        self.account(time.perf_counter())
+
+        if event == 'call':
+            label = frame_label(frame.f_code)
+            stage = STAGE_FUNCTIONS.get((os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+            self.push(label, stage)
+        elif event == 'c_call':
+            self.push(c_function_label(arg), None)
+        elif event in ('return', 'c_return', 'c_exception'):
+            # 記録開始より前に呼ばれた関数から戻るときは何もしない
+            if self.pushed:
+                for _ in range(self.pushed.pop()):
+                    self.stack.pop()
+
+        # 記録処理自体の時間は計上しない
+        self.last = time.perf_counter()
+
+    def push(self, label, stage):
+        if stage is not None:
+            self.stack.append(f"[{stage}]")
+        self.stack.append(label)
+        self.pushed.append(2 if stage is not None else 1)
+
+    def folded(self):
+        """折りたたみ形式の行（マイクロ秒、1未満は切り捨てて除く）"""
+        lines = []
+        for stack, seconds in sorted(self.times.items()):
+            micros = int(seconds * 1_000_000)
+            if micros:
+                lines.append(f"{';'.join(stack)} {micros}")
+        return '\n'.join(lines) + '\n'
+
+    def stage_totals(self):
+        """段階ごとの合計時間（秒、その段階の中で呼ばれた関数を含む、記録による遅れを含む）"""
+        totals = {stage: 0.0 for stage in STAGE_FUNCTIONS.values()}
+        for stack, seconds in self.times.items():
+            # 入れ子になった同じ段階（再帰）は一度だけ数える
+            for stage in {frame[1:-1] for frame in stack if frame.startswith('[')}:
+                if stage in totals:
+                    totals[stage] += seconds
+        return totals
+
+    def save(self, directory, name, keep=None):
+        """
+        プロファイルを directory/<時刻>-<name>-<pid>-<スレッドID>.folded に保存し、ファイル名を返す
+        keepを指定すると、保存後に新しいものからkeep件を残して古いプロファイルを削除する
+        """
+        os.makedirs(directory, exist_ok=True)
+        now = time.time()
+        timestamp = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}{int(now * 1000) % 1000:03d}"
+        filename = f"{timestamp}-{name}-{os.getpid()}-{self.thread_id}.folded"
+        tmp_path = os.path.join(directory, f"{filename}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(self.folded())
+        os.replace(tmp_path, os.path.join(directory, filename))
+        if keep is not None:
+            prune_profiles(directory, keep)
+        return filename
+
+def prune_profiles(directory, keep):
+    """directory内のプロファイル（.folded）を更新日時の新しいものからkeep件だけ残して削除"""
+    profiles = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.endswith('.folded'):
+            try:
+                profiles.append((entry.stat().st_mtime, entry.name, entry.path))
+            except FileNotFoundError:
+                continue  # 別のワーカーが先に削除した
+    profiles.sort(reverse=True)
+    for _, _, path in profiles[max(keep, 1):]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
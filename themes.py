@@ -0,0 +1,195 @@
+"""
+画像のテーマ（配色・グラデーション背景・文字の影/光彩・選手ごとのチームカラー）
+
+効果はNumPyの配列演算でまとめて計算し、描画済みのキャンバスに合成する（Pythonのピクセルループは使わない）。
+背景のグラデーションと固定テキスト（タイトル・vs・フッター）の効果は背景テンプレートと一緒に
+テーマごとにキャッシュし、スコアの数字などスプライトの効果はスプライトと一緒にキャッシュする。
+1回の描画で計算するのは選手名の効果だけで、それも文字がある範囲（＋効果の広がり）に限定する。
+
+描画1回あたりの追加時間の予算は EFFECT_BUDGET_MS（1080×1080、classicとの差の中央値）。
+benchmarks/bench_render.py が themes/* として計測し、予算を超えると終了コード1になる。
+計測値（コミット71d80bb、1vCPUの共有VM、`bench_render.py --repeat 150`、5セットマッチ・日本語名、
+classicの描画は約1.4ms）:
+    classic  +0ms（効果なし、従来と同じ画像）
+    sunset   +6.4ms（グラデーション・ドロップシャドウ1層）
+    night    +6.5ms（グラデーション・光彩1層）
+    night＋チームカラー（毎回違う色）  +6.9ms（背景テンプレートと数字の効果は色が違っても共有する）
+同じVM・同じコミットでも負荷によって実行ごとに1〜3ms程度ずれる（テーマ追加時のコミットメッセージの値は
+この計測で置き換える）。
+
+NumPyが無い環境では効果を省略し、配色・グラデーション無しの背景色・チームカラーのみ反映する。
+"""
+from PIL import Image
+import math
+import os
+
+try:
+    import numpy as np
+except ImportError:  # NumPy が無い環境では影・光彩・グラデーションを描かない
+    np = None
+
+# 効果による描画1回あたりの追加時間の予算（ミリ秒）
+EFFECT_BUDGET_MS = float(os.environ.get('EFFECT_BUDGET_MS', 10))
+
+class TextEffect:
+    """文字の影・光彩（文字の形をぼかし、ずらして、色を付けて文字の下に敷く）"""
+    def __init__(self, color, offset=(0, 0), radius=4, opacity=0.5):
+        self.color = color
+        self.offset = offset  # デザイン座標（1080×1080）でのずらし量
+        self.radius = radius  # ぼかし半径（箱型ぼかし3回分の1回あたり）
+        self.opacity = opacity  # 1より大きくすると光彩が強くなる（合成時に1で打ち切る）
+
+    def key(self):
+        return (tuple(self.color), tuple(self.offset), self.radius, self.opacity)
+
+class Theme:
+    """配色と効果の組み合わせ"""
+    def __init__(self, name, bg_color, primary_color, secondary_color, accent_color,
+                 gradient=None, text_effects=(), player_colors=(None, None)):
+        self.name = name
+        self.bg_color = bg_color
+        self.primary_color = primary_color
+        self.secondary_color = secondary_color
+        self.accent_color = accent_color
+        self.gradient = gradient  # (始点の色, 終点の色, 角度) 角度90で上から下
+        self.text_effects = tuple(text_effects)
+        self.player_colors = player_colors  # 選手ごとの名前・セット数の色（Noneならテーマの色）
+
+    def with_player_colors(self, color1=None, color2=None):
+        """チームカラーを指定したテーマ（指定の無い側は元のまま）"""
+        current1, current2 = self.player_colors
+        return Theme(self.name, self.bg_color, self.primary_color, self.secondary_color,
+                     self.accent_color, self.gradient, self.text_effects,
+                     (color1 or current1, color2 or current2))
+
+    def without_effects(self):
+        """影・光彩・グラデーションを除いたテーマ（混雑時の軽量な描画用）"""
+        return Theme(self.name, self.bg_color, self.primary_color, self.secondary_color,
+                     self.accent_color, None, (), self.player_colors)
+
+    def player_color(self, index, default):
+        return self.player_colors[index] or default
+
+    def background_key(self):
+        """背景テンプレートのキャッシュキー（チームカラーは毎回描く名前・セット数にしか使わないので含めない）"""
+        gradient = None
+        if self.gradient is not None:
+            start, end, angle = self.gradient
+            gradient = (tuple(start), tuple(end), angle)
+        return (self.name, tuple(self.bg_color), tuple(self.primary_color), tuple(self.secondary_color),
+                tuple(self.accent_color), gradient, tuple(effect.key() for effect in self.text_effects))
+
+    def key(self):
+        """結果画像のキャッシュキー（ETag）に使うキー（チームカラーを含む）"""
+        return self.background_key() + (tuple(tuple(color) if color else None for color in self.player_colors),)
+
+THEMES = {
+    # 従来の配色（効果なし）
+    'classic': Theme('classic', (255, 255, 255), (41, 128, 185), (52, 73, 94), (231, 76, 60)),
+    # 暖色のグラデーションとドロップシャドウ
+    'sunset': Theme('sunset', (255, 240, 225), (192, 57, 43), (44, 62, 80), (211, 84, 0),
+                    gradient=((255, 247, 235), (250, 200, 170), 60),
+                    text_effects=[TextEffect((0, 0, 0), offset=(4, 5), radius=4, opacity=0.35)]),
+    # 暗い背景と光彩
+    'night': Theme('night', (12, 18, 40), (93, 173, 226), (236, 240, 241), (241, 196, 15),
+                   gradient=((28, 40, 80), (6, 8, 22), 90),
+                   text_effects=[TextEffect((52, 152, 219), radius=6, opacity=1.4)]),
+}
+
+def effects_available():
+    return np is not None
+
+def parse_color(value):
+    """'#rrggbb' / 'rrggbb' を (R, G, B) に変換（不正ならValueError）"""
+    text = str(value).strip().lstrip('#')
+    if len(text) != 6:
+        raise ValueError(f"Invalid color: {value}")
+    return tuple(int(text[i:i + 2], 16) for i in (0, 2, 4))
+
+def gradient_array(width, height, start, end, angle=90):
+    """線形グラデーションの (高さ, 幅, 3) 配列（angleは度、0で左から右・90で上から下）"""
+    radians = math.radians(angle)
+    dx, dy = math.cos(radians), math.sin(radians)
+    # 各ピクセルをグラデーションの方向に射影し、0〜1に正規化する
+    t = (np.arange(width, dtype=np.float32)[None, :] * dx +
+         np.arange(height, dtype=np.float32)[:, None] * dy)
+    low = min(0.0, dx * (width - 1)) + min(0.0, dy * (height - 1))
+    high = max(0.0, dx * (width - 1)) + max(0.0, dy * (height - 1))
+    t = (t - low) / max(high - low, 1e-6)
+
+    start = np.array(start, dtype=np.float32)
+    end = np.array(end, dtype=np.float32)
+    return (start + (end - start) * t[..., None]).round().astype(np.uint8)
+
+def box_blur_axis(array, radius, axis):
+    """1軸方向の箱型ぼかし（累積和を使うので半径に関係なく1画素あたり定数時間）"""
+    pad = [(0, 0), (0, 0)]
+    pad[axis] = (radius + 1, radius)
+    summed = np.cumsum(np.pad(array, pad), axis=axis)
+    window = 2 * radius + 1
+    upper = [slice(None), slice(None)]
+    lower = [slice(None), slice(None)]
+    upper[axis] = slice(window, None)
+    lower[axis] = slice(None, -window)
+    return (summed[tuple(upper)] - summed[tuple(lower)]) / window
+
+def blur(array, radius):
+    """箱型ぼかしを縦横3回ずつかけてガウスぼかしに近似"""
+    for _ in range(3):
+        array = box_blur_axis(array, radius, 0)
+        array = box_blur_axis(array, radius, 1)
+    return array
+
+def shift(array, dx, dy):
+    """配列を (dx, dy) だけずらす（はみ出した部分は捨て、空いた部分は0）"""
+    if not dx and not dy:
+        return array
+    height, width = array.shape
+    shifted = np.zeros_like(array)
+    shifted[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)] = \
+        array[max(-dy, 0):height + min(-dy, 0), max(-dx, 0):width + min(-dx, 0)]
+    return shifted
+
+def effect_margin(effects, scale=1):
+    """効果が文字の外側に広がる最大の幅（ピクセル）"""
+    margin = 0
+    for effect in effects:
+        radius = max(1, round(effect.radius * scale / 2))
+        offset = max(abs(round(value * scale / 2)) for value in effect.offset)
+        margin = max(margin, 2 * (3 * radius + offset + 1))
+    return margin
+
+def effect_layers(mask, effects, scale=1):
+    """
+    文字のマスク（Lモード）から影・光彩のアルファ画像を作る
+    計算するのは文字がある範囲に効果の広がりを足した矩形だけで、ぼかしは半分の解像度で行う
+    （影・光彩は滑らかなので見た目はほぼ変わらず、計算量は1/4になる）
+    Returns:
+        [(色, アルファ画像, マスク上の左上座標)] （効果の順、文字が無ければ空）
+    """
+    if np is None or not effects:
+        return []
+    bbox = mask.getbbox()
+    if bbox is None:
+        return []
+
+    margin = effect_margin(effects, scale)
+    left, top, right, bottom = bbox
+    box = (max(0, left - margin), max(0, top - margin),
+           min(mask.width, right + margin), min(mask.height, bottom + margin))
+    size = (box[2] - box[0], box[3] - box[1])
+    coverage = np.asarray(mask.crop(box).reduce(2), dtype=np.float32) / 255
+
+    layers = []
+    for effect in effects:
+        radius = max(1, round(effect.radius * scale / 2))
+        dx, dy = (round(value * scale / 2) for value in effect.offset)
+        alpha = np.clip(shift(blur(coverage, radius), dx, dy) * (255 * effect.opacity), 0, 255)
+        layer = Image.fromarray(alpha.round().astype(np.uint8), 'L').resize(size, Image.BILINEAR)
+        layers.append((tuple(effect.color), layer, box[:2]))
+    return layers
+
+def apply_text_effects(canvas, mask, effects, scale=1):
+    """文字のマスクから影・光彩を作り、canvas（RGB）にその場で合成する"""
+    for color, layer, position in effect_layers(mask, effects, scale):
+        canvas.paste(color, position, layer)